@@ -0,0 +1,181 @@
+"""
+backends.py
+Inference backends for the text-generation model
+"""
+
+import importlib.util
+import json
+import os
+
+BACKENDS = ["pytorch", "int8", "compile", "onnx"]
+# Weight precisions for the pytorch and compile backends
+DTYPES = ["float32", "float16", "bfloat16"]
+
+# Written last when a snapshot is saved, so a partial snapshot is never used
+SNAPSHOT_MARKER = "snapshot.json"
+
+
+def conv1d_to_linear(model):
+    """
+    Replace GPT-2 style Conv1D layers with equivalent nn.Linear layers.
+
+    GPT-2 models implement their projections as transformers' Conv1D, which
+    dynamic quantization does not recognise. Conv1D computes x @ W + b with
+    W of shape (in, out), so the Linear weight is W transposed.
+    """
+    import torch
+    from transformers.pytorch_utils import Conv1D
+
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features)
+                with torch.no_grad():
+                    linear.weight.copy_(child.weight.t())
+                    linear.bias.copy_(child.bias)
+                setattr(parent, name, linear)
+    return model
+
+
+def quantize_int8(model):
+    """Dynamically quantize the model's linear layers to int8 (CPU only)."""
+    import torch
+
+    model = conv1d_to_linear(model)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def compile_model(model):
+    """Compile the model's forward pass with torch.compile, keeping generate() usable."""
+    import torch
+
+    model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+
+def resolve_dtype(dtype):
+    """torch dtype named by dtype, or None to keep the checkpoint's default (float32)."""
+    if dtype is None:
+        return None
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype '{dtype}', expected one of {', '.join(DTYPES)}")
+    import torch
+
+    return getattr(torch, dtype)
+
+
+def snapshot_format(backend):
+    """Storage format of a backend's snapshots."""
+    return "onnx" if backend == "onnx" else "safetensors"
+
+
+def find_snapshot(snapshot_dir, model_name, backend, dtype=None):
+    """
+    Return snapshot_dir if it holds a complete snapshot of model_name usable by backend.
+
+    A snapshot saved in a reduced precision is only used at that precision.
+
+    Returns:
+        str: The snapshot directory, or None if it must be (re)built
+    """
+    if not snapshot_dir:
+        return None
+    try:
+        with open(os.path.join(snapshot_dir, SNAPSHOT_MARKER), encoding="utf-8") as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if marker.get("model_name") != model_name or marker.get("format") != snapshot_format(backend):
+        return None
+    if marker.get("dtype") != dtype:
+        return None
+    return snapshot_dir
+
+
+def mark_snapshot(snapshot_dir, model_name, backend, dtype=None):
+    """Record that snapshot_dir now holds a complete snapshot of model_name."""
+    marker = {"model_name": model_name, "format": snapshot_format(backend)}
+    if dtype is not None:
+        marker["dtype"] = dtype
+    with open(os.path.join(snapshot_dir, SNAPSHOT_MARKER), "w", encoding="utf-8") as f:
+        json.dump(marker, f)
+
+
+def load_onnx(model_name, snapshot_dir=None):
+    """
+    Load the model with ONNX Runtime (requires optimum).
+
+    model_name is exported to ONNX unless it is an exported snapshot; with
+    snapshot_dir the export is saved there so restarts skip it.
+    """
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM
+    except ImportError:
+        raise ImportError(
+            "The onnx backend needs optimum with ONNX Runtime: "
+            "pip install optimum[onnxruntime]"
+        )
+    exported = os.path.exists(os.path.join(model_name, SNAPSHOT_MARKER))
+    model = ORTModelForCausalLM.from_pretrained(model_name, export=not exported)
+    if snapshot_dir:
+        model.save_pretrained(snapshot_dir)
+    return model
+
+
+def load_backend_model(model_name, backend="pytorch", device=-1, snapshot_dir=None, dtype=None,
+                       low_cpu_mem_usage=None):
+    """
+    Load a causal language model prepared for the given backend.
+
+    The weights are loaded straight into the model with
+    low_cpu_mem_usage (when accelerate is installed), instead of building a
+    randomly initialised model and copying a full state dict into it, which
+    roughly halves peak memory during the load. dtype loads them in reduced
+    precision; bfloat16 is the one to use on CPU.
+
+    With snapshot_dir, the weights as loaded (before quantization or
+    compilation, which are cheap to redo) are saved there as safetensors,
+    which later loads memory-map instead of deserializing. Pass the
+    snapshot directory as model_name to load from it.
+
+    Args:
+        model_name (str): Hugging Face model name or local path
+        backend (str): One of BACKENDS
+        device (int): Pipeline device index, -1 for CPU
+        snapshot_dir (str): Directory to save a snapshot of the loaded weights in
+        dtype (str): One of DTYPES, or None for float32
+        low_cpu_mem_usage (bool): Override the accelerate-based default, e.g. to measure its effect
+
+    Returns:
+        The model object to hand to the text-generation pipeline
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    if dtype not in (None, "float32") and backend in ("int8", "onnx"):
+        raise ValueError(f"The {backend} backend runs in float32; use the pytorch or compile backend for {dtype}")
+    torch_dtype = resolve_dtype(dtype)
+
+    if backend == "onnx":
+        return load_onnx(model_name, snapshot_dir)
+
+    from transformers import AutoModelForCausalLM
+
+    if low_cpu_mem_usage is None:
+        low_cpu_mem_usage = importlib.util.find_spec("accelerate") is not None
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=torch_dtype,
+        low_cpu_mem_usage=low_cpu_mem_usage
+    )
+    model.eval()
+    if snapshot_dir:
+        model.save_pretrained(snapshot_dir, safe_serialization=True)
+
+    if backend == "int8":
+        if device != -1:
+            raise ValueError("The int8 backend only runs on CPU")
+        model = quantize_int8(model)
+    elif backend == "compile":
+        model = compile_model(model)
+    return model
@@ -0,0 +1,338 @@
+"""
+batch_runner.py
+Runs scripted conversations from JSONL offline, batching model-bound turns across conversations
+"""
+
+from interface import ChatbotInterface
+from backends import BACKENDS, DTYPES
+from chat_memory import ChatMemory
+from knowledge_base import SQLiteKnowledgeBase
+from response_cache import ResponseCache
+import argparse
+import contextlib
+import json
+import sys
+import time
+
+
+class ScriptedConversation:
+    """One input conversation being worked through, turn by turn."""
+
+    def __init__(self, conversation_id, turns, memory):
+        self.id = conversation_id
+        self.turns = turns
+        self.next_turn = 0
+        self.memory = memory
+        self.current_context = None
+        self.responses = []
+        # The model-bound turn waiting for its batch: (message, model_prompt, query_type)
+        self.waiting = None
+
+    def finished(self):
+        return self.waiting is None and self.next_turn >= len(self.turns)
+
+    def to_dict(self):
+        return {"id": self.id, "responses": self.responses}
+
+
+def read_conversations(lines):
+    """
+    Parse JSONL conversations lazily, one line at a time.
+
+    Each line is {"id": ..., "turns": ["message", ...]}; the id defaults to
+    the line number. Lines that cannot be used are yielded as error records.
+
+    Yields:
+        tuple: (id, list of messages, None) or (line number, None, error message)
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            turns = record["turns"]
+            if not isinstance(turns, list) or not all(isinstance(turn, str) for turn in turns):
+                raise ValueError("turns must be a list of strings")
+        except (ValueError, KeyError, TypeError) as e:
+            yield number, None, f"Line {number}: {e}"
+            continue
+        yield record.get("id", number), turns, None
+
+
+class BatchRunner:
+    def __init__(self, model_name="distilgpt2", memory_turns=5, max_batch_size=8, max_active=64,
+                 max_new_tokens=50, knowledge_base=None, response_cache=None, backend="pytorch",
+                 dtype=None):
+        """
+        Answer scripted conversations without an interactive loop.
+
+        Up to max_active conversations are worked on at once. Greetings,
+        knowledge-base answers and response-cache hits are answered straight
+        away; a turn that needs the model waits until max_batch_size such
+        turns from different conversations (or all that can be collected)
+        are ready, and they are generated together. A conversation's next
+        turn is only taken once its previous one is answered, so each one
+        sees the same history as in an interactive session.
+
+        Finished conversations are written out and dropped, so memory use
+        depends on max_active, not on the size of the input.
+
+        Args:
+            model_name (str): Hugging Face model name
+            memory_turns (int): Number of conversation turns to remember per conversation
+            max_batch_size (int): Maximum prompts per generator call
+            max_active (int): Conversations held in memory at once
+            max_new_tokens (int): Tokens to generate per model-bound turn
+            knowledge_base: Backend for factual answers, defaults to the built-in facts
+            response_cache (ResponseCache): Cache of generated responses, off by default
+            backend (str): Inference backend: "pytorch", "int8", "compile" or "onnx"
+            dtype (str): Weight precision, "float16" or "bfloat16"; float32 by default
+        """
+        self.chatbot = ChatbotInterface(
+            model_name=model_name,
+            memory_turns=memory_turns,
+            knowledge_base=knowledge_base,
+            response_cache=response_cache,
+            backend=backend,
+            dtype=dtype
+        )
+        self.model_loader = self.chatbot.model_loader
+        self.response_cache = response_cache
+        self.memory_turns = memory_turns
+        self.max_batch_size = max_batch_size
+        self.max_active = max(max_active, max_batch_size)
+        self.max_new_tokens = max_new_tokens
+        self.max_prompt_tokens = None
+        self.stats = {
+            "conversations": 0,
+            "errors": 0,
+            "failed_turns": 0,
+            "turns": 0,
+            "fast_path_turns": 0,
+            "model_turns": 0,
+            "batches": 0,
+            "generation_seconds": 0.0
+        }
+
+    def initialize(self):
+        """Load the model, reporting progress on stderr so stdout stays JSONL."""
+        print(f"Loading model: {self.model_loader.model_name}...", file=sys.stderr)
+        self.model_loader.load_model(verbose=False)
+        window = self.model_loader.context_window()
+        if window:
+            self.max_prompt_tokens = window - self.max_new_tokens
+
+    def _start(self, conversation_id, turns):
+        memory = ChatMemory(
+            max_turns=self.memory_turns,
+            max_prompt_tokens=self.max_prompt_tokens,
+            count_tokens=self.model_loader.count_tokens if self.model_loader.is_ready() else None
+        )
+        return ScriptedConversation(conversation_id, turns, memory)
+
+    def _record(self, conversation, message, response, query_type):
+        conversation.responses.append({"input": message, "response": response, "query_type": query_type})
+        self.stats["turns"] += 1
+
+    def _advance(self, conversation):
+        """
+        Answer the conversation's turns until one needs the model or none are left.
+
+        Returns:
+            bool: True if a turn is now waiting for the model
+        """
+        loader = self.model_loader
+        params = loader.cache_params(self.max_new_tokens)
+        while conversation.next_turn < len(conversation.turns):
+            message = conversation.turns[conversation.next_turn].strip()
+            conversation.next_turn += 1
+            memory = conversation.memory
+            if message.lower() == "/clear":
+                memory.clear()
+                conversation.current_context = None
+                self._record(conversation, message, "Conversation history cleared.", "command")
+                continue
+
+            model_prompt = memory.get_prompt(message)
+            loader.current_context = conversation.current_context
+            topic, context, query_type = loader.parse_query(message, memory)
+            conversation.current_context = loader.current_context
+            memory.add_message("User", message, query_type)
+
+            response = loader.answer_from_knowledge(topic, query_type)
+            if response is None and self.response_cache is not None:
+                response = self.response_cache.get(message, model_prompt, params)
+            if response is None:
+                conversation.waiting = (message, model_prompt, query_type)
+                return True
+
+            self.stats["fast_path_turns"] += 1
+            self._finish_turn(conversation, message, response, query_type)
+        return False
+
+    def _finish_turn(self, conversation, message, response, query_type):
+        response = self.chatbot.finalize_response(response, message)
+        conversation.memory.add_message("Bot", response, query_type)
+        self._record(conversation, message, response, query_type)
+
+    def _generate(self, batch):
+        """
+        Generate the waiting turns of a batch of conversations together.
+
+        If the batch fails (e.g. out of memory), its turns are recorded with
+        the error and their conversations carry on with the next turn.
+        """
+        start = time.perf_counter()
+        prompts = [conversation.waiting[1] for conversation in batch]
+        try:
+            if self.model_loader.is_ready():
+                results = self.model_loader.generate_batch(prompts, max_new_tokens=self.max_new_tokens)
+            else:
+                results = [""] * len(batch)
+        except Exception as e:
+            print(f"Error generating a batch of {len(batch)}: {e}", file=sys.stderr)
+            results = None
+            error = str(e)
+        self.stats["batches"] += 1
+        self.stats["model_turns"] += len(batch)
+        self.stats["generation_seconds"] += time.perf_counter() - start
+
+        if results is None:
+            for conversation in batch:
+                message, _, query_type = conversation.waiting
+                conversation.waiting = None
+                conversation.responses.append({"input": message, "error": error, "query_type": query_type})
+                self.stats["turns"] += 1
+                self.stats["failed_turns"] += 1
+            return
+
+        params = self.model_loader.cache_params(self.max_new_tokens)
+        for conversation, result in zip(batch, results):
+            message, model_prompt, query_type = conversation.waiting
+            conversation.waiting = None
+            if self.response_cache is not None:
+                self.model_loader.cache_response(message, model_prompt, params, result)
+            self._finish_turn(conversation, message, result, query_type)
+
+    def run(self, lines, output):
+        """
+        Answer every conversation in lines and write one JSON result per conversation.
+
+        Results are written as conversations finish, which is not
+        necessarily the input order; each carries the conversation's id.
+
+        Args:
+            lines (iterable): JSONL input, e.g. an open file or sys.stdin
+            output (file): Where the JSONL results are written
+
+        Returns:
+            dict: Run statistics
+        """
+        start = time.perf_counter()
+        conversations = read_conversations(lines)
+        active = []
+        waiting = []
+        exhausted = False
+
+        while True:
+            # Take in new conversations while there is room
+            while not exhausted and len(active) < self.max_active:
+                item = next(conversations, None)
+                if item is None:
+                    exhausted = True
+                    break
+                conversation_id, turns, error = item
+                if error is not None:
+                    self.stats["errors"] += 1
+                    output.write(json.dumps({"id": conversation_id, "error": error}) + "\n")
+                    continue
+                conversation = self._start(conversation_id, turns)
+                active.append(conversation)
+                if self._advance(conversation):
+                    waiting.append(conversation)
+
+            # Write out and drop conversations with nothing left to answer
+            still_active = []
+            for conversation in active:
+                if conversation.finished():
+                    self.stats["conversations"] += 1
+                    output.write(json.dumps(conversation.to_dict()) + "\n")
+                else:
+                    still_active.append(conversation)
+            active = still_active
+
+            if not waiting:
+                if exhausted and not active:
+                    break
+                continue
+
+            batch, waiting = waiting[:self.max_batch_size], waiting[self.max_batch_size:]
+            self._generate(batch)
+            for conversation in batch:
+                if self._advance(conversation):
+                    waiting.append(conversation)
+
+        output.flush()
+        self.stats["elapsed_seconds"] = time.perf_counter() - start
+        if self.stats["batches"]:
+            self.stats["average_batch_size"] = self.stats["model_turns"] / self.stats["batches"]
+        return self.stats
+
+
+def main():
+    """Run conversations from a JSONL file or stdin and write the responses as JSONL."""
+    parser = argparse.ArgumentParser(
+        description="Answer scripted conversations offline. Each input line is "
+                    '{"id": ..., "turns": ["message", ...]}; each output line is '
+                    '{"id": ..., "responses": [{"input", "response", "query_type"}, ...]}'
+    )
+    parser.add_argument("input", nargs="?", default="-", help="JSONL conversations (default: stdin)")
+    parser.add_argument("-o", "--output", default="-", help="JSONL results (default: stdout)")
+    parser.add_argument("--model", default="distilgpt2", help="Hugging Face model name")
+    parser.add_argument("--memory-turns", type=int, default=5)
+    parser.add_argument("--backend", default="pytorch", choices=BACKENDS, help="Inference backend")
+    parser.add_argument("--dtype", choices=DTYPES, help="Weight precision (default float32)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Maximum prompts per generation batch")
+    parser.add_argument("--max-active", type=int, default=64, help="Conversations held in memory at once")
+    parser.add_argument("--max-new-tokens", type=int, default=50, help="Tokens to generate per model-bound turn")
+    parser.add_argument("--knowledge-base", help="SQLite knowledge base built with knowledge_base.py")
+    parser.add_argument("--response-cache", help="JSON file for the response cache (enables caching)")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Maximum cached responses")
+    args = parser.parse_args()
+
+    knowledge_base = SQLiteKnowledgeBase(args.knowledge_base) if args.knowledge_base else None
+    response_cache = (
+        ResponseCache(max_entries=args.cache_size, path=args.response_cache)
+        if args.response_cache else None
+    )
+    runner = BatchRunner(
+        model_name=args.model,
+        memory_turns=args.memory_turns,
+        max_batch_size=args.batch_size,
+        max_active=args.max_active,
+        max_new_tokens=args.max_new_tokens,
+        knowledge_base=knowledge_base,
+        response_cache=response_cache,
+        backend=args.backend,
+        dtype=args.dtype
+    )
+    source = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        # Anything printed while loading or answering (errors included) goes
+        # to stderr; only the results are written to output
+        with contextlib.redirect_stdout(sys.stderr):
+            runner.initialize()
+            stats = runner.run(source, output)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+        if response_cache is not None:
+            response_cache.save()
+    print(json.dumps(stats, indent=2), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
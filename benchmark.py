@@ -0,0 +1,437 @@
+"""
+benchmark.py
+Reproducible latency and throughput benchmark for the chatbot
+"""
+
+from interface import ChatbotInterface
+from backends import DTYPES, load_backend_model
+from chat_memory import ChatMemory
+from model_registry import peak_rss_mb
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Scripted conversations, including the README's multi-turn follow-ups
+CONVERSATIONS = [
+    ["What is the capital of France?", "Tell me about places to visit there", "What about Italy?"],
+    ["hello", "what is the capital of germany", "and japan", "what is the capital of india"],
+    ["Tell me a story about a dragon", "What happened next?", "How does it end?"],
+    ["Why is the sky blue?", "How do rainbows form?", "Can you explain that more simply?"],
+    ["What should I cook for dinner tonight?", "Something with pasta", "How long does it take?"]
+]
+
+# Raw model outputs used for the post-processing microbenchmark
+SAMPLE_RESPONSES = [
+    "Paris is a lovely city. It has many museums and parks. User: what else",
+    "[laughs] This person would be the best guide. Bot: You should visit the old town!",
+    "I think the answer is that light scatters in the atmosphere. Blue light scatters more.",
+    "Assistant: The dragon flew over the mountains and found a cave full of gold and jewels."
+]
+
+
+def percentile(values, fraction):
+    """Linear-interpolated percentile of a list of numbers."""
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(seconds):
+    """Latency summary in milliseconds."""
+    if not seconds:
+        return {"count": 0}
+    ms = [s * 1000 for s in seconds]
+    return {
+        "count": len(ms),
+        "mean_ms": statistics.mean(ms),
+        "p50_ms": percentile(ms, 0.50),
+        "p95_ms": percentile(ms, 0.95),
+        "p99_ms": percentile(ms, 0.99)
+    }
+
+
+def build_tiny_model(path, seed=0):
+    """
+    Write a small randomly initialised GPT-2 and word-level tokenizer to path.
+
+    Everything is built locally, so the benchmark runs offline. The output is
+    gibberish, but the model exercises the same code paths as a real one.
+    """
+    from tokenizers import Tokenizer, models, normalizers, pre_tokenizers
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+    import torch
+
+    corpus = " ".join(
+        [ChatMemory.BASE_PROMPT, "User: Bot: Assistant:"]
+        + [turn for conversation in CONVERSATIONS for turn in conversation]
+        + SAMPLE_RESPONSES
+    )
+    vocab = {"<|endoftext|>": 0, "[UNK]": 1}
+    for word in re.findall(r"\w+|[^\w\s]", corpus.lower()):
+        vocab.setdefault(word, len(vocab))
+
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.normalizer = normalizers.Lowercase()
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|endoftext|>",
+        unk_token="[UNK]",
+        model_max_length=256
+    ).save_pretrained(path)
+
+    torch.manual_seed(seed)
+    config = GPT2Config(
+        vocab_size=len(vocab),
+        n_positions=256,
+        n_embd=64,
+        n_layer=2,
+        n_head=2,
+        bos_token_id=0,
+        eos_token_id=0
+    )
+    GPT2LMHeadModel(config).save_pretrained(path)
+    return path
+
+
+def time_per_call(function, arguments, repeat):
+    """Mean microseconds per call of function over each argument, repeated."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for argument in arguments:
+            function(argument)
+    return (time.perf_counter() - start) / (repeat * len(arguments)) * 1e6
+
+
+def cold_start_child(config):
+    """
+    Load the model once and print when it was ready; run in a fresh process by measure_cold_start.
+
+    Args:
+        config (dict): ChatbotInterface arguments
+    """
+    chatbot = ChatbotInterface(**config)
+    chatbot.model_loader.load_model(verbose=False)
+    ready = time.time()
+    print(json.dumps({
+        "ready": ready,
+        "startup": chatbot.model_loader.startup_stats,
+        "peak_rss_mb": peak_rss_mb()
+    }))
+
+
+def run_child(flag, config):
+    """Run this script with a child flag in a new process and return the JSON it printed last."""
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), flag, json.dumps(config)],
+        capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark process {flag} failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def load_memory_child(config):
+    """Load the weights once and print the peak RSS the load added; run by measure_load_memory."""
+    # Imported up front so only the load itself is measured
+    import torch
+    import transformers
+
+    before = peak_rss_mb()
+    load_backend_model(**config)
+    after = peak_rss_mb()
+    print(json.dumps({"load_peak_mb": None if before is None else after - before}))
+
+
+def measure_load_memory(model_name, backend="pytorch", dtype=None):
+    """
+    Peak memory added by loading the weights, with and without low_cpu_mem_usage.
+
+    Each variant loads in its own process, since peak RSS never goes down.
+    Without accelerate only the full-copy load can be measured.
+
+    Returns:
+        dict: MB added at peak per variant (None if it could not run)
+    """
+    results = {}
+    for name, low_cpu_mem_usage in (("low_cpu_mem_usage", True), ("full_copy", False)):
+        if low_cpu_mem_usage and importlib.util.find_spec("accelerate") is None:
+            results[name] = None
+            continue
+        config = {"model_name": model_name, "backend": backend, "dtype": dtype,
+                  "low_cpu_mem_usage": low_cpu_mem_usage}
+        results[name] = run_child("--load-memory-child", config)["load_peak_mb"]
+    if results["low_cpu_mem_usage"] is not None and results["full_copy"]:
+        results["saving"] = 1 - results["low_cpu_mem_usage"] / results["full_copy"]
+    return results
+
+
+def measure_cold_start(**config):
+    """
+    Time a first model load in a new Python process.
+
+    The clock starts before the interpreter launches, so interpreter start,
+    library imports, weight loading and any warm-up are all included; in the
+    benchmark process itself torch and transformers are already imported.
+
+    Args:
+        **config: ChatbotInterface arguments
+
+    Returns:
+        dict: cold_start_seconds, the child's startup stats and its peak RSS
+    """
+    launched = time.time()
+    child = run_child("--cold-start-child", config)
+    return {
+        "cold_start_seconds": child["ready"] - launched,
+        "startup": child["startup"],
+        "peak_rss_mb": child["peak_rss_mb"]
+    }
+
+
+def run_benchmark(model_name, backend="pytorch", rounds=3, micro_repeat=200, seed=0,
+                  draft_model_name=None, num_assistant_tokens=5, snapshot_dir=None, warmup_lengths=None,
+                  dtype=None):
+    """
+    Drive the chatbot through the scripted conversations and collect metrics.
+
+    Returns:
+        dict: Machine-readable results
+    """
+    import torch
+
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+    results = {}
+
+    config = {
+        "model_name": model_name,
+        "backend": backend,
+        "draft_model_name": draft_model_name,
+        "num_assistant_tokens": num_assistant_tokens,
+        "snapshot_dir": snapshot_dir,
+        "warmup_lengths": list(warmup_lengths) if warmup_lengths else warmup_lengths,
+        "dtype": dtype
+    }
+    # Cold start, import/load split, snapshot use and warm-up first-token
+    # latencies, all from a fresh process
+    cold = measure_cold_start(**config)
+    results["cold_start_seconds"] = cold["cold_start_seconds"]
+    results["startup"] = cold["startup"]
+    if backend != "onnx":
+        results["load_memory_mb"] = measure_load_memory(model_name, backend, dtype)
+
+    chatbot = ChatbotInterface(**config)
+    chatbot.model_loader.load_model(verbose=False)
+    loader = chatbot.model_loader
+
+    # End-to-end turns, as the CLI runs them
+    turn_seconds = {"all": [], "fast_path": [], "model": []}
+    for _ in range(rounds):
+        for conversation in CONVERSATIONS:
+            chatbot.memory.clear()
+            loader.reset_cache()
+            for user_input in conversation:
+                start = time.perf_counter()
+                model_prompt, parsed = chatbot.begin_turn(user_input)
+                bound = loader.answer_from_knowledge(parsed[0], parsed[2]) is None
+                chatbot.respond(user_input, model_prompt, parsed)
+                elapsed = time.perf_counter() - start
+                turn_seconds["all"].append(elapsed)
+                turn_seconds["model" if bound else "fast_path"].append(elapsed)
+    results["turn_latency"] = {name: summarize(values) for name, values in turn_seconds.items()}
+
+    # Generation throughput and time to first token on model-bound prompts
+    memory = ChatMemory(max_turns=5)
+    prompts = []
+    for conversation in CONVERSATIONS:
+        memory.clear()
+        for user_input in conversation:
+            parsed = loader.parse_query(user_input, memory)
+            if loader.answer_from_knowledge(parsed[0], parsed[2]) is None:
+                prompts.append((user_input, memory.get_prompt(user_input), parsed))
+            memory.add_message("User", user_input, parsed[2])
+            memory.add_message("Bot", "I see.", parsed[2])
+
+    generated_tokens = 0
+    generation_seconds = 0.0
+    first_token_seconds = []
+    for _ in range(rounds):
+        for user_input, model_prompt, parsed in prompts:
+            before = loader.generation_stats["generated_tokens"]
+            start = time.perf_counter()
+            loader.generate_response(
+                user_input, max_new_tokens=chatbot.max_new_tokens,
+                model_prompt=model_prompt, parsed=parsed
+            )
+            generation_seconds += time.perf_counter() - start
+            generated_tokens += loader.generation_stats["generated_tokens"] - before
+
+            start = time.perf_counter()
+            chunks, _ = loader.stream_response(
+                user_input, max_new_tokens=chatbot.max_new_tokens,
+                model_prompt=model_prompt, parsed=parsed
+            )
+            for _chunk in chunks:
+                first_token_seconds.append(time.perf_counter() - start)
+                break
+            if hasattr(chunks, "close"):
+                chunks.close()
+    results["generation"] = {
+        "prompts": len(prompts) * rounds,
+        "generated_tokens": generated_tokens,
+        "tokens_per_second": generated_tokens / generation_seconds if generation_seconds else None,
+        "time_to_first_token": summarize(first_token_seconds)
+    }
+    results["token_counts"] = dict(loader.generation_stats)
+    if loader.draft_model is not None:
+        results["speculative"] = loader.speculative_report()
+
+    # Microbenchmarks of the non-model stages
+    inputs = [turn for conversation in CONVERSATIONS for turn in conversation]
+    history = ChatMemory(max_turns=5)
+    for user_input in inputs[:10]:
+        history.add_message("User", user_input, "general")
+    results["microbenchmarks_us"] = {
+        "parse_query": time_per_call(lambda text: loader.parse_query(text, history), inputs, micro_repeat),
+        "clean_response": time_per_call(chatbot.clean_response, SAMPLE_RESPONSES, micro_repeat),
+        "is_valid_response": time_per_call(
+            lambda text: chatbot.is_valid_response(text, "what is this"), SAMPLE_RESPONSES, micro_repeat
+        )
+    }
+
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def environment(args):
+    """Details needed to compare results across commits and machines."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    import torch
+    import transformers
+
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "model": args.model,
+        "backend": args.backend,
+        "draft_model": args.draft_model,
+        "num_assistant_tokens": args.draft_tokens,
+        "snapshot_dir": args.snapshot_dir,
+        "warmup": args.warmup,
+        "rounds": args.rounds,
+        "seed": args.seed
+    }
+
+
+def flatten(data, prefix=""):
+    """Flatten nested dicts into dotted keys with numeric values."""
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline, current):
+    """Print the relative change of every metric against a baseline report, to stderr (stdout may hold the report)."""
+    before = flatten(baseline["results"])
+    after = flatten(current["results"])
+    print(f"{'metric':45} {'baseline':>12} {'current':>12} {'change':>8}", file=sys.stderr)
+    for name in sorted(set(before) & set(after)):
+        old, new = before[name], after[name]
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{name:45} {old:12.3f} {new:12.3f} {change:>8}", file=sys.stderr)
+
+
+def main():
+    """Run the benchmark and write a JSON report."""
+    parser = argparse.ArgumentParser(description="Benchmark chatbot turn latency and throughput")
+    parser.add_argument("--model", default="tiny",
+                        help="Hugging Face model name, or 'tiny' for a small local model (offline)")
+    parser.add_argument("--backend", default="pytorch", help="Inference backend (see backends.py)")
+    parser.add_argument("--draft-model", help="Draft model for speculative decoding")
+    parser.add_argument("--draft-tokens", type=int, default=5, help="Tokens proposed per draft step")
+    parser.add_argument("--snapshot-dir", help="Load from (or create) a safetensors snapshot of the model")
+    parser.add_argument("--dtype", choices=DTYPES, help="Weight precision (default float32)")
+    parser.add_argument("--warmup", type=int, nargs="*", metavar="TOKENS",
+                        help="Warm up with dummy prompts of these lengths before measuring (default 16 64 256)")
+    parser.add_argument("--rounds", type=int, default=3, help="Times each conversation is replayed")
+    parser.add_argument("--micro-repeat", type=int, default=200, help="Iterations per microbenchmark input")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against")
+    parser.add_argument("--cold-start-child", help=argparse.SUPPRESS)
+    parser.add_argument("--load-memory-child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold_start_child:
+        cold_start_child(json.loads(args.cold_start_child))
+        return
+    if args.load_memory_child:
+        load_memory_child(json.loads(args.load_memory_child))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_name = args.model
+        if model_name == "tiny":
+            os.environ.setdefault("HF_HUB_OFFLINE", "1")
+            model_name = build_tiny_model(tmp, seed=args.seed)
+        report = {
+            "environment": environment(args),
+            "results": run_benchmark(
+                model_name,
+                backend=args.backend,
+                draft_model_name=args.draft_model,
+                num_assistant_tokens=args.draft_tokens,
+                snapshot_dir=args.snapshot_dir,
+                dtype=args.dtype,
+                warmup_lengths=(tuple(args.warmup) or (16, 64, 256)) if args.warmup is not None else None,
+                rounds=args.rounds,
+                micro_repeat=args.micro_repeat,
+                seed=args.seed
+            )
+        }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
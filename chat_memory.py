@@ -1,20 +1,189 @@
 """
 chat_memory.py
-Manages conversation history using a sliding window buffer
+Manages conversation history: recent turns verbatim plus an index of the rest
 """
 
 from collections import deque
+import sys
+
+
+class Message:
+    """One message in the conversation; roles and query types are interned, so repeats share a string."""
+    __slots__ = ("role", "message", "query_type", "line", "tokens", "place")
+
+    def __init__(self, role, message, query_type=None, tokens=None):
+        self.role = sys.intern(role)
+        self.message = message
+        self.query_type = sys.intern(query_type) if query_type is not None else None
+        # The formatted prompt line is computed once
+        self.line = f"{role}: {message}\n"
+        self.tokens = tokens
+        # Place the message mentions, filled in once a place finder is set
+        self.place = None
+
+
+class ConversationIndex:
+    """
+    Facts about the whole conversation, updated in constant time per message.
+
+    parse_query reads these instead of scanning the history, and the topics
+    of turns that left the window are kept (a bounded number of them) for a
+    one-line summary in the prompt.
+    """
+
+    def __init__(self, max_topics=3):
+        self.messages = 0
+        self.last_place = None
+        self.last_query_type = None
+        # Newest "capital" or "places" query type
+        self.last_topic_type = None
+        self.capitals_in_window = 0
+        self.evicted = 0
+        self.evicted_topics = deque(maxlen=max_topics)
+
+    def add(self, entry):
+        """Index a message entering the window."""
+        self.messages += 1
+        if entry.place:
+            self.last_place = entry.place
+        if entry.query_type:
+            self.last_query_type = entry.query_type
+            if entry.query_type in ("capital", "places"):
+                self.last_topic_type = entry.query_type
+            if entry.query_type == "capital":
+                self.capitals_in_window += 1
+
+    def evict(self, entry):
+        """
+        Fold a message leaving the window into the summary.
+
+        Returns:
+            bool: True if the summary topics changed
+        """
+        self.evicted += 1
+        if entry.query_type == "capital":
+            self.capitals_in_window -= 1
+        if not entry.place or entry.query_type not in ("capital", "places"):
+            return False
+        topic = (entry.place, entry.query_type)
+        if self.evicted_topics and self.evicted_topics[-1] == topic:
+            return False
+        if topic in self.evicted_topics:
+            self.evicted_topics.remove(topic)
+        self.evicted_topics.append(topic)
+        return True
+
+    def summary(self):
+        """Prompt line naming the topics of evicted turns, or "" if there are none."""
+        if not self.evicted_topics:
+            return ""
+        topics = [
+            f"the capital of {place.title()}" if query_type == "capital" else f"places to visit in {place.title()}"
+            for place, query_type in self.evicted_topics
+        ]
+        return f"Earlier in the conversation: {', '.join(topics)}.\n"
+
 
 class ChatMemory:
-    def __init__(self, max_turns=5):
+    # Instructions placed at the start of every prompt
+    BASE_PROMPT = (
+        "The following is a conversation with an AI assistant. "
+        "The assistant is helpful, knowledgeable, and direct.\n\n"
+    )
+
+    def __init__(self, max_turns=5, max_prompt_tokens=None, count_tokens=None, store=None, session_id=None):
         """
         Initialize the chat memory with a sliding window.
         
+        With a store and session_id, messages are also written to the store
+        and the last window of an earlier session with that ID is resumed.
+        
         Args:
             max_turns (int): Maximum number of conversation turns to remember
+            max_prompt_tokens (int): Token budget for prompts built by get_prompt
+            count_tokens (callable): Returns the number of tokens in a string
+            store (ConversationStore): Persistent storage for the conversation
+            session_id (str): Key of this conversation in the store
         """
         self.max_turns = max_turns
         self.buffer = deque(maxlen=max_turns * 2)  # *2 for user + bot messages
+        self.max_prompt_tokens = max_prompt_tokens
+        self.count_tokens = None
+        self.base_prompt_tokens = 0
+        self.store = store
+        self.session_id = session_id
+        # Maps lowercase text to the place it mentions (see set_place_finder)
+        self.place_finder = None
+        self.index = ConversationIndex()
+        self.summary = ""
+        self.summary_tokens = 0
+        if store is not None and session_id is not None:
+            self.resume()
+        if count_tokens is not None:
+            self.set_token_counter(count_tokens)
+    
+    def resume(self):
+        """
+        Load the most recent messages of this session from the store.
+        
+        Only the last window is read, however long the stored history is.
+        
+        Returns:
+            int: Number of messages loaded
+        """
+        self.buffer.clear()
+        self.index = ConversationIndex()
+        self._set_summary("")
+        messages = self.store.load_recent(self.session_id, self.buffer.maxlen)
+        for message in messages:
+            if self.count_tokens is not None:
+                message.tokens = self.count_tokens(message.line)
+            if self.place_finder is not None:
+                message.place = self.place_finder(message.message.lower())
+            self.buffer.append(message)
+            self.index.add(message)
+        return len(messages)
+    
+    def set_place_finder(self, find_place):
+        """
+        Tag each message with the place it mentions, once, as it is added.
+        
+        Messages already in the window are tagged and re-indexed here.
+        
+        Args:
+            find_place (callable): Maps lowercase text to a place name or None
+        """
+        self.place_finder = find_place
+        evicted = self.index
+        self.index = ConversationIndex(evicted.evicted_topics.maxlen)
+        self.index.evicted = evicted.evicted
+        self.index.evicted_topics.extend(evicted.evicted_topics)
+        for entry in self.buffer:
+            entry.place = find_place(entry.message.lower())
+            self.index.add(entry)
+    
+    def _set_summary(self, summary):
+        self.summary = summary
+        self.summary_tokens = self.count_tokens(summary) if self.count_tokens and summary else 0
+    
+    def set_token_counter(self, count_tokens, max_prompt_tokens=None):
+        """
+        Enable token-aware prompts.
+        
+        Messages already in the buffer are counted once here; new messages
+        are counted as they are added.
+        
+        Args:
+            count_tokens (callable): Returns the number of tokens in a string
+            max_prompt_tokens (int): Token budget, keeps the current one if None
+        """
+        self.count_tokens = count_tokens
+        if max_prompt_tokens is not None:
+            self.max_prompt_tokens = max_prompt_tokens
+        self.base_prompt_tokens = count_tokens(self.BASE_PROMPT)
+        self._set_summary(self.summary)
+        for entry in self.buffer:
+            entry.tokens = count_tokens(entry.line)
         
     def add_message(self, role, message, query_type=None):
         """
@@ -25,11 +194,19 @@ class ChatMemory:
             message (str): The message content
             query_type (str): Type of query (capital, places, etc.)
         """
-        self.buffer.append({
-            "role": role, 
-            "message": message,
-            "query_type": query_type
-        })
+        # The token count is computed once here
+        entry = Message(role, message, query_type)
+        if self.count_tokens:
+            entry.tokens = self.count_tokens(entry.line)
+        if self.place_finder is not None:
+            entry.place = self.place_finder(message.lower())
+        # The oldest message leaves the window; only its topic is kept
+        if len(self.buffer) == self.buffer.maxlen and self.index.evict(self.buffer[0]):
+            self._set_summary(self.index.summary())
+        self.buffer.append(entry)
+        self.index.add(entry)
+        if self.store is not None and self.session_id is not None:
+            self.store.append(self.session_id, entry)
     
     def get_context(self):
         """
@@ -41,42 +218,97 @@ class ChatMemory:
         if not self.buffer:
             return ""
         
-        context = "\n".join([
-            f"{entry['role']}: {entry['message']}"
-            for entry in self.buffer
-        ])
+        return "".join(entry.line for entry in self.buffer)[:-1]
+    
+    def get_history_lines(self, reserved_tokens=0):
+        """
+        Select history lines that fit the token budget, newest first.
+        
+        Args:
+            reserved_tokens (int): Budget already taken by the rest of the prompt
+            
+        Returns:
+            list: Formatted lines in chronological order
+        """
+        if self.max_prompt_tokens is None or self.count_tokens is None:
+            return [entry.line for entry in self.buffer]
         
-        return context
+        budget = self.max_prompt_tokens - self.base_prompt_tokens - self.summary_tokens - reserved_tokens
+        lines = []
+        for entry in reversed(self.buffer):
+            budget -= entry.tokens
+            if budget < 0:
+                break
+            lines.append(entry.line)
+        lines.reverse()
+        return lines
     
     def get_prompt(self, new_user_input):
         """
         Create a prompt combining conversation history and new input.
         
+        With a token budget, the newest messages that fit are included and
+        older ones are left out; token counts come from add_message, so the
+        history is not re-tokenized. An input too long for the budget on its
+        own is cut to its end. Topics of turns that have left the
+        window are named in one summary line, so the prompt stays bounded
+        however long the conversation runs.
+        
         Args:
             new_user_input (str): The latest user input
             
         Returns:
             str: Complete prompt for the model
         """
+        # Format each turn of conversation clearly
+        turn, reserved = self._fit_turn(new_user_input)
+        summary = self.summary
+        if self.max_prompt_tokens is not None and reserved:
+            # An input that fills the budget leaves no room for the summary either
+            if self.base_prompt_tokens + self.summary_tokens + reserved > self.max_prompt_tokens:
+                summary = ""
+        
         # Start with basic instructions for better responses
-        base_prompt = (
-            "The following is a conversation with an AI assistant. "
-            "The assistant is helpful, knowledgeable, and direct.\n\n"
-        )
+        return "".join([self.BASE_PROMPT, summary, *self.get_history_lines(reserved), turn])
+    
+    def _fit_turn(self, new_user_input):
+        """
+        Format the new turn, keeping only the tail of an input too long for the budget.
         
-        context = self.get_context()
+        The end of a long input is usually the question, so the start is
+        dropped. The longest tail that fits is found by bisecting its length.
         
-        if context:
-            # Format each turn of conversation clearly
-            prompt = f"{base_prompt}{context}\nUser: {new_user_input}\nAssistant:"
-        else:
-            prompt = f"{base_prompt}User: {new_user_input}\nAssistant:"
+        Returns:
+            tuple: (turn text, its token count or 0 without a token counter)
+        """
+        turn = f"User: {new_user_input}\nAssistant:"
+        if self.count_tokens is None:
+            return turn, 0
+        tokens = self.count_tokens(turn)
+        if self.max_prompt_tokens is None:
+            return turn, tokens
+        budget = self.max_prompt_tokens - self.base_prompt_tokens
+        if tokens <= budget:
+            return turn, tokens
         
-        return prompt
+        low, high = 0, len(new_user_input)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(f"User: {new_user_input[-middle:]}\nAssistant:") <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        tail = new_user_input[len(new_user_input) - low:]
+        turn = f"User: {tail}\nAssistant:"
+        return turn, self.count_tokens(turn)
     
     def clear(self):
-        """Clear all conversation history."""
+        """Clear all conversation history, including the stored session."""
         self.buffer.clear()
+        self.index = ConversationIndex(self.index.evicted_topics.maxlen)
+        self._set_summary("")
+        if self.store is not None and self.session_id is not None:
+            self.store.delete_session(self.session_id)
     
     def get_history_length(self):
         """Get the current number of messages in buffer."""
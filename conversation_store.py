@@ -0,0 +1,177 @@
+"""
+conversation_store.py
+Persistent conversation history, so sessions survive restarts
+"""
+
+from chat_memory import Message
+import atexit
+import sqlite3
+import threading
+
+
+class ConversationStore:
+    def __init__(self, path, flush_interval=1.0, max_pending=256):
+        """
+        Conversation history stored in SQLite.
+
+        The database runs in WAL mode with synchronous=NORMAL, so commits do
+        not wait for an fsync. Appended messages are queued and written in
+        one transaction per flush: every flush_interval seconds from a
+        background thread, once max_pending messages are queued, and at
+        exit. A crash of the process loses at most the queued messages.
+
+        Messages are keyed by (session, sequence number) in a WITHOUT ROWID
+        table, and session IDs are stored once and referenced by number, so
+        loading the last few messages of a session is one short index scan.
+
+        Args:
+            path (str): Database file, created if it does not exist
+            flush_interval (float): Seconds between background flushes
+            max_pending (int): Queued messages that trigger an immediate flush
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = []
+        self._session_ids = {}
+        self._next_seq = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._closed = False
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "session INTEGER NOT NULL, seq INTEGER NOT NULL, "
+                "role TEXT NOT NULL, message TEXT NOT NULL, query_type TEXT, "
+                "PRIMARY KEY (session, seq)) WITHOUT ROWID"
+            )
+
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _session_id(self, name, create):
+        """Numeric ID of a session (the lock must be held), or None if it does not exist."""
+        session = self._session_ids.get(name)
+        if session is None:
+            row = self.connection.execute("SELECT id FROM sessions WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                if not create:
+                    return None
+                row = (self.connection.execute("INSERT INTO sessions (name) VALUES (?)", (name,)).lastrowid,)
+            session = self._session_ids[name] = row[0]
+        return session
+
+    def _seq(self, session):
+        """Next sequence number in a session (the lock must be held)."""
+        seq = self._next_seq.get(session)
+        if seq is None:
+            row = self.connection.execute(
+                "SELECT MAX(seq) FROM messages WHERE session = ?", (session,)
+            ).fetchone()
+            seq = 0 if row[0] is None else row[0] + 1
+        self._next_seq[session] = seq + 1
+        return seq
+
+    def append(self, session_id, message):
+        """
+        Queue a message for writing.
+
+        Args:
+            session_id (str): Conversation the message belongs to
+            message (Message): The message; only role, text and query type are stored
+        """
+        with self._lock:
+            self.pending.append((session_id, message.role, message.message, message.query_type))
+            if len(self.pending) >= self.max_pending:
+                self._wake.notify()
+
+    def flush(self):
+        """Write all queued messages in one transaction."""
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self.pending or self._closed:
+            return
+        pending, self.pending = self.pending, []
+        session_ids, next_seq = dict(self._session_ids), dict(self._next_seq)
+        try:
+            with self.connection:
+                rows = []
+                for session_id, role, message, query_type in pending:
+                    session = self._session_id(session_id, create=True)
+                    rows.append((session, self._seq(session), role, message, query_type))
+                self.connection.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error:
+            # The transaction was rolled back (e.g. "database is locked" with
+            # several worker processes): queue the messages again for the next
+            # flush and forget the session IDs and sequence numbers it assigned
+            self.pending = pending + self.pending
+            self._session_ids, self._next_seq = session_ids, next_seq
+            raise
+
+    def _flush_periodically(self):
+        with self._lock:
+            while not self._closed:
+                self._wake.wait(self.flush_interval)
+                try:
+                    self._flush_locked()
+                except sqlite3.Error as e:
+                    print(f"Error saving conversations: {e}")
+
+    def load_recent(self, session_id, limit):
+        """
+        Load the last messages of a session.
+
+        Args:
+            session_id (str): Conversation to load
+            limit (int): Maximum number of messages
+
+        Returns:
+            list: Messages in chronological order (empty for an unknown session)
+        """
+        with self._lock:
+            self._flush_locked()
+            session = self._session_id(session_id, create=False)
+            if session is None:
+                return []
+            rows = self.connection.execute(
+                "SELECT role, message, query_type FROM messages WHERE session = ? ORDER BY seq DESC LIMIT ?",
+                (session, limit)
+            ).fetchall()
+        return [Message(role, message, query_type) for role, message, query_type in reversed(rows)]
+
+    def delete_session(self, session_id):
+        """Delete a session's stored messages."""
+        with self._lock:
+            self._flush_locked()
+            session = self._session_id(session_id, create=False)
+            if session is None:
+                return
+            with self.connection:
+                self.connection.execute("DELETE FROM messages WHERE session = ?", (session,))
+            self._next_seq.pop(session, None)
+
+    def sessions(self):
+        """IDs of all stored sessions."""
+        with self._lock:
+            self._flush_locked()
+            return [row[0] for row in self.connection.execute("SELECT name FROM sessions ORDER BY id")]
+
+    def close(self):
+        """Flush queued messages and close the database."""
+        with self._lock:
+            if self._closed:
+                return
+            self._flush_locked()
+            self._closed = True
+            self._wake.notify()
+            self.connection.close()
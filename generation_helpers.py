@@ -0,0 +1,103 @@
+"""
+generation_helpers.py
+Helpers around transformers generation, imported once a model is needed
+"""
+
+from transformers import StoppingCriteria
+import contextlib
+import contextvars
+import functools
+
+# First transformers release whose generate() prefills only the uncached
+# tail of input_ids (via cache_position); older ones, e.g. GPT-2 on 4.30,
+# feed just the last token whenever a cache is passed in
+PREFIX_REUSE_MIN_VERSION = "4.45.0"
+
+# Forward-pass counts of the generate() call running in this context, if any
+_forward_counts = contextvars.ContextVar("forward_counts", default=None)
+
+
+class StopOnEvent(StoppingCriteria):
+    """Stops generation at the next token once the given event is set."""
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+class StopOnText(StoppingCriteria):
+    """
+    Stops each sequence once the text it has generated is a finished turn.
+
+    Only tokens after prompt_length are decoded, and is_finished decides
+    on the text. One flag is returned per sequence, so finished rows of a
+    batch stop while the others carry on.
+    """
+
+    def __init__(self, tokenizer, prompt_length, is_finished):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.is_finished = is_finished
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+
+        texts = self.tokenizer.batch_decode(input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        return torch.tensor([self.is_finished(text) for text in texts], dtype=torch.bool, device=input_ids.device)
+
+
+def count_forward_calls(model, key):
+    """
+    Count forward passes of model under key, in the counts of counting_forward_calls.
+
+    Passes outside a counting_forward_calls block are not counted, so one
+    hook serves every loader sharing the model.
+
+    Returns:
+        RemovableHandle: Removes the hook again
+    """
+    def hook(module, inputs, output):
+        counts = _forward_counts.get()
+        if counts is not None:
+            counts[key] = counts.get(key, 0) + 1
+    return model.register_forward_hook(hook)
+
+
+@contextlib.contextmanager
+def counting_forward_calls(counts):
+    """Add forward passes made in this context while the block runs to counts."""
+    token = _forward_counts.set(counts)
+    try:
+        yield counts
+    finally:
+        _forward_counts.reset(token)
+
+
+@functools.lru_cache(maxsize=None)
+def supports_prefix_reuse():
+    """True if the installed transformers can continue generation from a cropped cache."""
+    import transformers
+    from packaging.version import Version
+
+    return Version(transformers.__version__) >= Version(PREFIX_REUSE_MIN_VERSION)
+
+
+def cache_length(past_key_values):
+    """Number of positions held in a key/value cache."""
+    if hasattr(past_key_values, "get_seq_length"):
+        return past_key_values.get_seq_length()
+    return past_key_values[0][0].shape[2]
+
+
+def crop_cache(past_key_values, length):
+    """Truncate a key/value cache to its first `length` positions."""
+    if hasattr(past_key_values, "crop"):
+        past_key_values.crop(length)
+        return past_key_values
+    # Legacy tuple-of-tuples cache: (batch, heads, seq, head_dim) per layer
+    return tuple(
+        (key[:, :, :length], value[:, :, :length])
+        for key, value in past_key_values
+    )
@@ -0,0 +1,196 @@
+"""
+generation_policy.py
+Chooses generation length, sampling and whether to run the model from each turn's query type and outcomes
+"""
+
+from collections import deque
+import math
+import threading
+
+# Starting points per query type. Capital and places questions only reach
+# the model when the knowledge base has no answer.
+DEFAULT_SETTINGS = {
+    "capital": {"max_new_tokens": 24, "sampling": {"temperature": 0.2, "top_k": 10}},
+    "places": {"max_new_tokens": 50, "sampling": {}},
+    "general": {"max_new_tokens": 40, "sampling": {}}
+}
+
+# Inputs of at most this many words ("and there?") form their own bucket
+SHORT_INPUT_WORDS = 3
+
+
+class GenerationPlan:
+    """How to generate one turn."""
+    __slots__ = ("key", "max_new_tokens", "sampling", "skip_model")
+
+    def __init__(self, key, max_new_tokens, sampling, skip_model=False):
+        self.key = key
+        self.max_new_tokens = max_new_tokens
+        self.sampling = sampling
+        self.skip_model = skip_model
+
+
+class _Bucket:
+    """Recent outcomes of one (query type, input length) bucket."""
+    __slots__ = ("valid", "lengths", "headroom", "turns", "model_turns", "skipped", "low_turns",
+                 "valid_turns", "generated_tokens", "truncated")
+
+    def __init__(self, window):
+        self.valid = deque(maxlen=window)
+        # Tokens used by valid responses; those cut off at the limit count as
+        # the limit, so the limit grows once over a tenth of them hit it
+        self.lengths = deque(maxlen=window)
+        self.headroom = None
+        self.turns = 0
+        self.model_turns = 0
+        self.skipped = 0
+        # Turns planned while the valid rate was too low, skipped or probing
+        self.low_turns = 0
+        self.valid_turns = 0
+        self.generated_tokens = 0
+        self.truncated = 0
+
+
+class GenerationPolicy:
+    def __init__(self, max_new_tokens=50, min_new_tokens=8, settings=None, window=50, min_samples=10,
+                 headroom=1.25, skip_below=0.1, probe_every=10):
+        """
+        Adapt model-bound turns to what they have needed so far.
+
+        Turns are grouped by query type and by whether the input is short.
+        Each group starts at the settings of its query type. Once it has
+        min_samples valid responses, its token limit becomes the 90th
+        percentile of the lengths those responses actually used, times
+        headroom. When a response that hit the limit turns out invalid, the
+        group's headroom grows, so limits only shrink while answers stay
+        valid. A group whose recent responses are almost never valid
+        (below skip_below) skips the model and goes straight to the
+        fallback, except every probe_every-th turn, which keeps its
+        statistics current.
+
+        Args:
+            max_new_tokens (int): Upper bound on any turn's token limit
+            min_new_tokens (int): Lower bound on any turn's token limit
+            settings (dict): Query type -> {"max_new_tokens", "sampling"}, defaults to DEFAULT_SETTINGS
+            window (int): Recent turns per group that the statistics cover
+            min_samples (int): Outcomes needed before a group is adapted
+            headroom (float): Margin over the observed lengths
+            skip_below (float): Valid rate under which the model is skipped
+            probe_every (int): Skipped turns between turns that run the model anyway
+        """
+        self.max_new_tokens = max_new_tokens
+        self.min_new_tokens = min_new_tokens
+        self.settings = DEFAULT_SETTINGS if settings is None else settings
+        self.window = window
+        self.min_samples = min_samples
+        self.headroom = headroom
+        self.skip_below = skip_below
+        self.probe_every = probe_every
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def _settings(self, query_type):
+        return self.settings.get(query_type) or self.settings.get("general", {})
+
+    def _base_tokens(self, query_type):
+        base = self._settings(query_type).get("max_new_tokens", self.max_new_tokens)
+        return max(self.min_new_tokens, min(base, self.max_new_tokens))
+
+    def _limit(self, bucket, base):
+        """Token limit of a bucket (the lock must be held)."""
+        if len(bucket.lengths) < self.min_samples:
+            return base
+        lengths = sorted(bucket.lengths)
+        p90 = lengths[min(len(lengths) - 1, int(len(lengths) * 0.9))]
+        limit = math.ceil(p90 * (bucket.headroom or self.headroom))
+        return max(self.min_new_tokens, min(limit, base))
+
+    def plan(self, query_type, user_input):
+        """
+        Decide how to generate a model-bound turn.
+
+        Args:
+            query_type (str): Query type from parse_query
+            user_input (str): The user's input
+
+        Returns:
+            GenerationPlan: Token limit, sampling overrides and whether to skip the model
+        """
+        length = "short" if len(user_input.split()) <= SHORT_INPUT_WORDS else "long"
+        key = (query_type or "general", length)
+        base = self._base_tokens(key[0])
+        sampling = self._settings(key[0]).get("sampling") or None
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = _Bucket(self.window)
+            bucket.turns += 1
+            skip = False
+            if len(bucket.valid) >= self.min_samples and sum(bucket.valid) < self.skip_below * len(bucket.valid):
+                bucket.low_turns += 1
+                skip = bucket.low_turns % self.probe_every != 0
+            if skip:
+                bucket.skipped += 1
+                return GenerationPlan(key, 0, sampling, skip_model=True)
+            return GenerationPlan(key, self._limit(bucket, base), sampling)
+
+    def record(self, plan, valid, generated_tokens):
+        """
+        Record how a planned turn went.
+
+        Args:
+            plan (GenerationPlan): The plan the turn ran with
+            valid (bool): Whether the response passed validation
+            generated_tokens (int): Tokens in the raw response
+        """
+        if plan is None or plan.skip_model:
+            return
+        with self._lock:
+            bucket = self.buckets[plan.key]
+            bucket.model_turns += 1
+            bucket.generated_tokens += generated_tokens
+            bucket.valid.append(valid)
+            truncated = generated_tokens >= plan.max_new_tokens
+            if truncated:
+                bucket.truncated += 1
+            if valid:
+                bucket.valid_turns += 1
+                bucket.lengths.append(generated_tokens)
+            elif truncated:
+                # The limit may have cut the answer short; allow longer ones
+                bucket.headroom = min((bucket.headroom or self.headroom) * 1.5, 4.0)
+
+    def get_stats(self):
+        """Per-group statistics for tuning, keyed "query_type/short" or "query_type/long"."""
+        with self._lock:
+            stats = {}
+            for (query_type, length), bucket in sorted(self.buckets.items()):
+                stats[f"{query_type}/{length}"] = {
+                    "turns": bucket.turns,
+                    "model_turns": bucket.model_turns,
+                    "skipped": bucket.skipped,
+                    "valid_rate": bucket.valid_turns / bucket.model_turns if bucket.model_turns else None,
+                    "recent_valid_rate": sum(bucket.valid) / len(bucket.valid) if bucket.valid else None,
+                    "mean_tokens": bucket.generated_tokens / bucket.model_turns if bucket.model_turns else None,
+                    "truncated": bucket.truncated,
+                    "max_new_tokens": self._limit(bucket, self._base_tokens(query_type))
+                }
+            return stats
+
+    def format_table(self):
+        """Human-readable statistics for the CLI."""
+        stats = self.get_stats()
+        if not stats:
+            return "Generation policy: no model-bound turns yet"
+        lines = [
+            "Generation policy:",
+            f"  {'group':16} {'turns':>6} {'model':>6} {'skipped':>8} {'valid':>7} {'tokens':>7} {'limit':>6}"
+        ]
+        for name, group in stats.items():
+            valid = f"{group['valid_rate']:.0%}" if group["valid_rate"] is not None else "-"
+            tokens = f"{group['mean_tokens']:.1f}" if group["mean_tokens"] is not None else "-"
+            lines.append(
+                f"  {name:16} {group['turns']:6d} {group['model_turns']:6d} {group['skipped']:8d} "
+                f"{valid:>7} {tokens:>7} {group['max_new_tokens']:6d}"
+            )
+        return "\n".join(lines)
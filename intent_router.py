@@ -0,0 +1,97 @@
+"""
+intent_router.py
+Keyword and place matching for query routing, compiled once up front
+"""
+
+import re
+
+# Keyword groups recognised in user input, matched as whole words
+INTENT_KEYWORDS = {
+    "greeting": ["hi", "hello", "hey"],
+    "followup": ["what about", "how about", "what of", "and", "what is"],
+    "there": ["there", "that place", "that country", "it"],
+    "capital": ["capital", "capitol"],
+    "places": ["visit", "places", "attractions", "see", "where",
+               "tell me about", "things", "tourists"]
+}
+
+WORD = re.compile(r"\w+")
+
+
+def normalize_place(name):
+    """Lowercase a place name and reduce it to single-space separated words."""
+    return " ".join(WORD.findall(name.lower()))
+
+
+class PlaceSet:
+    """In-memory gazetteer over a set of place names."""
+
+    def __init__(self, places):
+        self.places = {normalize_place(place) for place in places} - {""}
+        self.max_place_words = max((len(place.split()) for place in self.places), default=1)
+
+    def known(self, names):
+        """Return the subset of names that are known places."""
+        return self.places.intersection(names)
+
+
+class IntentRouter:
+    def __init__(self, places, keywords=None):
+        """
+        Build the matchers for a set of known places.
+
+        All keyword groups are folded into one regex with a named group per
+        intent, so classifying an input is a single scan. Places are looked
+        up as word n-grams in the gazetteer, so the cost depends on the input
+        length rather than on how many places are known.
+
+        Args:
+            places: A gazetteer with known(names) and max_place_words (such
+                as a knowledge base), or an iterable of place names
+            keywords (dict): Intent name -> list of keyword phrases
+        """
+        keywords = keywords or INTENT_KEYWORDS
+        groups = []
+        for intent, words in keywords.items():
+            # Longest first so multi-word phrases win over their prefixes
+            alternatives = sorted(words, key=len, reverse=True)
+            groups.append(f"(?P<{intent}>{'|'.join(re.escape(w) for w in alternatives)})")
+        self.keyword_pattern = re.compile(r"\b(?:" + "|".join(groups) + r")\b")
+
+        if not hasattr(places, "known"):
+            places = PlaceSet(places)
+        self.gazetteer = places
+
+    def intents(self, text):
+        """
+        Find which keyword groups occur in text.
+
+        Args:
+            text (str): Lowercase user input
+
+        Returns:
+            set: Names of the intents whose keywords appear
+        """
+        return {match.lastgroup for match in self.keyword_pattern.finditer(text)}
+
+    def find_place(self, text):
+        """
+        Find the first known place mentioned in text.
+
+        Args:
+            text (str): Lowercase text
+
+        Returns:
+            str: The place name, or None if no known place is mentioned
+        """
+        words = WORD.findall(text)
+        max_words = self.gazetteer.max_place_words
+        # Earlier words first; at each word the longest name first
+        # ("united states" over "united")
+        candidates = [
+            " ".join(words[start:start + length])
+            for start in range(len(words))
+            for length in range(min(max_words, len(words) - start), 0, -1)
+        ]
+        known = self.gazetteer.known(candidates)
+        return next((candidate for candidate in candidates if candidate in known), None)
@@ -5,19 +5,146 @@ Command-line interface for the chatbot
 
 from model_loader import ModelLoader
 from chat_memory import ChatMemory
+from generation_policy import GenerationPolicy
+from response_filters import ResponseFilter, SPEAKER_LABEL, EMPTY_RESPONSE, NO_SENTENCES_RESPONSE
+from tracing import Tracer
+from collections import deque
+import asyncio
+import json
+import signal
 import sys
+import threading
+
+
+class StreamingReply:
+    def __init__(self, chatbot, user_input, plan=None):
+        """
+        Print a streamed response as it arrives, showing only text that will survive cleanup.
+        
+        Args:
+            chatbot (ChatbotInterface): Supplies the response filter and fallbacks
+            user_input (str): The user's input
+            plan (GenerationPlan): The turn's generation plan, whose outcome is recorded
+        """
+        self.chatbot = chatbot
+        self.user_input = user_input
+        self.plan = plan
+        self.raw = ""
+        self.shown = ""
+    
+    def feed(self, chunk):
+        """
+        Add a decoded chunk and print any newly settled text.
+        
+        Returns:
+            bool: True once no more output is needed
+        """
+        self.raw += chunk
+        partial, finished = self.chatbot.clean_partial_response(self.raw)
+        if self.chatbot.is_rejected_partial(partial, self.user_input):
+            return True
+        if partial.startswith(self.shown) and len(partial) > len(self.shown):
+            if not self.shown:
+                print("Bot: ", end="")
+            print(partial[len(self.shown):], end="", flush=True)
+            self.shown = partial
+        return finished
+    
+    def finish(self):
+        """
+        Clean the full response, print whatever was not shown yet and return it.
+        
+        Returns:
+            str: The response to remember
+        """
+        raw = self.raw
+        match = SPEAKER_LABEL.search(raw)
+        if match:
+            raw = raw[:match.start()]
+        bot_response = self.chatbot.clean_response(raw)
+        shown = self.shown
+        valid = self.chatbot.is_valid_response(bot_response, self.user_input)
+        self.chatbot.record_outcome(self.plan, self.raw, bot_response, valid)
+        
+        if not valid:
+            bot_response = self.chatbot.generate_fallback_response(self.user_input)
+            if shown:
+                print()
+            print(f"Bot: {bot_response}\n")
+        elif shown and bot_response.startswith(shown):
+            print(f"{bot_response[len(shown):]}\n")
+        else:
+            if shown:
+                print()
+            print(f"Bot: {bot_response}\n")
+        return bot_response
+    
+    def cancel(self):
+        """End the output line of a cancelled response."""
+        if self.shown:
+            print()
+        print("(response cancelled)\n")
+
 
 class ChatbotInterface:
-    def __init__(self, model_name="distilgpt2", memory_turns=5):
+    def __init__(self, model_name="distilgpt2", memory_turns=5, stream=False, knowledge_base=None,
+                 response_cache=None, startup="eager", backend="pytorch", memory_tokens=None,
+                 response_filter=None, best_of=1, draft_model_name=None, num_assistant_tokens=5,
+                 conversation_store=None, session_id="default", trace=False, snapshot_dir=None,
+                 warmup_lengths=None, dtype=None, generation_policy=None):
         """
         Initialize the chatbot interface.
         
         Args:
             model_name (str): Hugging Face model name
             memory_turns (int): Number of conversation turns to remember
+            stream (bool): Print model responses token by token as they are generated
+            knowledge_base: Backend for factual answers, defaults to the built-in facts
+            response_cache (ResponseCache): Cache of generated responses, off by default
+            startup (str): When to load the model: "eager" (before the prompt),
+                "background" (in a thread while chatting) or "lazy" (on the
+                first query that needs it)
+            backend (str): Inference backend: "pytorch", "int8", "compile" or "onnx"
+            memory_tokens (int): Token budget for the prompt, defaults to the
+                model's context window minus the generated tokens
+            response_filter (ResponseFilter): Cleanup and validity rules, defaults to the built-in ones
+            best_of (int): Candidates sampled per model-bound turn; the best valid one is used
+            draft_model_name (str): Small model for speculative decoding, off by default
+            num_assistant_tokens (int): Tokens the draft model proposes per verification
+            conversation_store (ConversationStore): Persists the conversation, off by default
+            session_id (str): Conversation to resume from and save to the store
+            trace (bool): Record per-stage timings and hit counters (see /stats)
+            snapshot_dir (str): Directory for a fast-loading copy of the weights, made on first load
+            warmup_lengths (tuple): Prompt lengths (tokens) of dummy generations run after loading
+            dtype (str): Weight precision, "float16" or "bfloat16"; float32 by default.
+                Interfaces with the same model settings share one loaded copy
+            generation_policy (GenerationPolicy): Picks each model-bound turn's
+                length and sampling from its query type and recent outcomes;
+                every turn uses max_new_tokens without one
         """
-        self.model_loader = ModelLoader(model_name)
-        self.memory = ChatMemory(max_turns=memory_turns)
+        # Post-processing rules are compiled once here
+        self.response_filter = response_filter or ResponseFilter()
+        self.model_loader = ModelLoader(
+            model_name,
+            knowledge_base=knowledge_base,
+            response_cache=response_cache,
+            backend=backend,
+            draft_model_name=draft_model_name,
+            num_assistant_tokens=num_assistant_tokens,
+            tracer=Tracer(enabled=trace),
+            snapshot_dir=snapshot_dir,
+            warmup_lengths=warmup_lengths,
+            dtype=dtype,
+            response_filter=self.response_filter  # Generation stops where cleanup would cut
+        )
+        self.tracer = self.model_loader.tracer
+        self.memory = ChatMemory(max_turns=memory_turns, store=conversation_store, session_id=session_id)
+        self.memory_tokens = memory_tokens
+        self.best_of = best_of
+        self.max_new_tokens = 50  # Allow slightly longer responses
+        self.generation_policy = generation_policy
+        self.stream = stream
+        self.startup = startup
         self.is_running = False
         
     def initialize(self):
@@ -27,6 +154,20 @@ class ChatbotInterface:
         print("=" * 60)
         print()
         
+        if self.memory.get_history_length():
+            print(f"Resumed conversation '{self.memory.session_id}' "
+                  f"({self.memory.get_history_length()} recent messages).\n")
+        
+        if self.startup == "background":
+            self.model_loader.start_loading()
+            print(f"Model {self.model_loader.model_name} is warming up in the background.")
+            print("Greetings and known facts are answered right away.\n")
+            return True
+        if self.startup == "lazy":
+            self.model_loader.load_on_demand = True
+            print(f"Model {self.model_loader.model_name} will load on the first question that needs it.\n")
+            return True
+        
         try:
             self.model_loader.load_model()
             print()
@@ -40,6 +181,8 @@ class ChatbotInterface:
         print("\nAvailable commands:")
         print("  /exit    - Exit the chatbot")
         print("  /clear   - Clear conversation history")
+        print("  /cancel  - Stop the response being generated (or press Ctrl+C)")
+        print("  /stats   - Show per-stage timings (/stats json, /stats prometheus)")
         print("  /help    - Show this help message")
         print()
     
@@ -71,42 +214,19 @@ class ChatbotInterface:
                     self.handle_command(user_input)
                     continue
                 
-                # Update memory before generating response
-                topic, context, initial_type = self.model_loader.parse_query(user_input)
-                self.memory.add_message("User", user_input, initial_type)
+                # Record the user turn and build the model prompt
+                model_prompt, parsed = self.begin_turn(user_input)
+                self.show_warming_notice(parsed)
                 
                 try:
-                    # Get bot response with updated history
-                    response_tuple = self.model_loader.generate_response(
-                        user_input,  # Pass just the user input
-                        conversation_history=self.memory.buffer,  # Pass the updated history
-                        max_new_tokens=50  # Allow slightly longer responses
-                    )
-                    
-                    # Unpack response and query type
-                    if isinstance(response_tuple, tuple):
-                        bot_response, query_type = response_tuple
-                    else:
-                        bot_response, query_type = response_tuple, None
-                    
-                    # Clean up response
-                    bot_response = self.clean_response(bot_response)
+                    if self.stream and self.best_of == 1:
+                        self.respond_streaming(user_input, model_prompt, parsed)
+                        continue
+
+                    bot_response, query_type = self.respond(user_input, model_prompt, parsed)
                     
-                    # Validate response
-                    if self.is_valid_response(bot_response, user_input):
-                        # Update memory with the bot response and query type
-                        self.memory.add_message("Bot", bot_response, query_type)
-                        
-                        # Display response
-                        print(f"Bot: {bot_response}\n")
-                    else:
-                        # Generate a fallback response
-                        fallback = self.generate_fallback_response(user_input)
-                        
-                        # Update memory with fallback response
-                        self.memory.add_message("Bot", fallback, query_type)
-                        
-                        print(f"Bot: {fallback}\n")
+                    # Display response
+                    print(f"Bot: {bot_response}\n")
                     
                 except KeyboardInterrupt:
                     print("\n\nExiting chatbot. Goodbye!")
@@ -121,59 +241,449 @@ class ChatbotInterface:
                 print("Please try again or type /exit to quit.\n")
                 continue
     
-    def clean_response(self, response):
+    async def run_async(self):
         """
-        Clean and format the bot response.
+        Start the chatbot interaction loop on the running asyncio event loop.
+        
+        Input is read on its own thread, so the user can keep typing while the
+        model works: lines typed during a response are queued as the next
+        turns, and /cancel or Ctrl+C stops the response at its next token
+        without leaving the chatbot.
+        """
+        if not self.initialize():
+            return
+        
+        self.display_help()
+        print("Start chatting! (Type /exit to quit)\n")
+        
+        self.is_running = True
+        loop = asyncio.get_running_loop()
+        lines = asyncio.Queue()
+        typed_ahead = deque()
+        turn = None
+        
+        def read_lines():
+            for line in sys.stdin:
+                loop.call_soon_threadsafe(lines.put_nowait, line)
+            loop.call_soon_threadsafe(lines.put_nowait, None)
+        
+        def interrupt():
+            if turn is not None and not turn.done():
+                turn.cancel()
+            else:
+                lines.put_nowait(None)
+        
+        threading.Thread(target=read_lines, daemon=True).start()
+        try:
+            loop.add_signal_handler(signal.SIGINT, interrupt)
+        except (NotImplementedError, RuntimeError):
+            pass  # No signal handlers here; Ctrl+C exits as in run()
+        
+        try:
+            while self.is_running:
+                if typed_ahead:
+                    line = typed_ahead.popleft()
+                else:
+                    print("User: ", end="", flush=True)
+                    line = await lines.get()
+                if line is None:
+                    print("\n\nExiting chatbot. Goodbye!")
+                    break
+                
+                user_input = line.strip()
+                if not user_input:
+                    continue
+                if user_input.startswith("/"):
+                    self.handle_command(user_input)
+                    continue
+                
+                turn = asyncio.ensure_future(self.respond_async(user_input))
+                while not turn.done():
+                    reader = asyncio.ensure_future(lines.get())
+                    await asyncio.wait({turn, reader}, return_when=asyncio.FIRST_COMPLETED)
+                    if not reader.done():
+                        reader.cancel()
+                        continue
+                    line = reader.result()
+                    if line is not None and line.strip().lower() == "/cancel":
+                        turn.cancel()
+                    else:
+                        typed_ahead.append(line)
+                await asyncio.wait({turn})
+                
+                if not turn.cancelled() and turn.exception() is not None:
+                    print(f"Error generating response: {str(turn.exception())}")
+                    print("Bot: I apologize, but I'm having trouble generating a response right now.\n")
+        finally:
+            try:
+                loop.remove_signal_handler(signal.SIGINT)
+            except (NotImplementedError, RuntimeError):
+                pass
+    
+    async def respond_async(self, user_input):
+        """
+        Run and print one turn, with the model work in an executor.
+        
+        Cancelling the task stops the model at its next token; the user's
+        message stays in memory without a bot response.
         
         Args:
-            response (str): Raw model output
+            user_input (str): The user's input
             
         Returns:
-            str: Cleaned response
+            tuple: (response text, query type)
         """
-        import re
-
-        # Check if response is empty or None
-        if not response:
-            return "I apologize, but I'm having trouble generating a response."
-        
-        # Remove common unwanted patterns
-        unwanted_patterns = [
-            r'\[.*?\]',          # Text in square brackets
-            r'Bot:',             # Speaker labels
-            r'User:',
-            r'Human:',
-            r'Assistant:',
-            r'System:',
-            r'Instructions:.*?\\n\\n',  # Remove instruction block
-            r'Example interactions:.*?Current conversation:',  # Remove examples
-            r'This person would be',     # Common irrelevant starts
-            r'No other word for',
-            r'Or do anyone'
-        ]
+        model_prompt, parsed = self.begin_turn(user_input)
+        self.show_warming_notice(parsed)
+        loader = self.model_loader
+        query_type = parsed[2]
+        plan = self.plan_generation(user_input, parsed)
+        max_new_tokens, sampling = self.generation_settings(plan)
         
-        for pattern in unwanted_patterns:
-            response = re.sub(pattern, '', response)
+        if plan is not None and plan.skip_model:
+            bot_response = self.skipped_response(user_input)
+            print(f"Bot: {bot_response}\n")
+        elif self.best_of > 1 and loader.answer_from_knowledge(parsed[0], query_type) is None:
+            try:
+                candidates = await loader.generate_candidates_async(
+                    model_prompt, self.best_of, max_new_tokens=max_new_tokens, sampling=sampling
+                )
+            except asyncio.CancelledError:
+                print("(response cancelled)\n")
+                raise
+            bot_response = self.pick_best_candidate(candidates, user_input, plan)
+            print(f"Bot: {bot_response}\n")
+        elif self.stream:
+            chunks, query_type = await loader.stream_response_async(
+                user_input,
+                conversation_history=self.memory,
+                max_new_tokens=max_new_tokens,
+                model_prompt=model_prompt,
+                parsed=parsed,
+                sampling=sampling
+            )
+            reply = StreamingReply(self, user_input, plan if query_type != "error" else None)
+            try:
+                async for chunk in chunks:
+                    if reply.feed(chunk):
+                        break
+            except asyncio.CancelledError:
+                reply.cancel()
+                raise
+            finally:
+                await chunks.aclose()
+            bot_response = reply.finish()
+        else:
+            try:
+                bot_response, query_type = await loader.generate_response_async(
+                    user_input,
+                    conversation_history=self.memory,
+                    max_new_tokens=max_new_tokens,
+                    model_prompt=model_prompt,
+                    parsed=parsed,
+                    sampling=sampling
+                )
+            except asyncio.CancelledError:
+                print("(response cancelled)\n")
+                raise
+            bot_response = self.finalize_response(
+                bot_response, user_input, plan if query_type != "error" else None
+            )
+            print(f"Bot: {bot_response}\n")
         
-        # Clean up the text
-        response = ' '.join(response.split())  # Normalize whitespace
+        self.memory.add_message("Bot", bot_response, query_type)
+        self.tracer.finish_turn()
+        return bot_response, query_type
+    
+    def begin_turn(self, user_input):
+        """
+        Parse the user's input and add it to memory.
+        
+        Args:
+            user_input (str): The user's input
+            
+        Returns:
+            tuple: (model prompt built from the history before this turn, parse_query result)
+        """
+        self.tracer.start_turn()
+        self.configure_memory()
+        with self.tracer.stage("build_prompt"):
+            model_prompt = self.memory.get_prompt(user_input)
+        
+        # Parse once per turn; the result is reused for generation
+        parsed = self.model_loader.parse_query(user_input, self.memory)
+        self.memory.add_message("User", user_input, parsed[2])
+        return model_prompt, parsed
+    
+    def respond(self, user_input, model_prompt, parsed):
+        """
+        Generate, clean and remember the bot's response to a turn started with begin_turn.
+        
+        Returns:
+            tuple: (response text, query type)
+        """
+        plan = self.plan_generation(user_input, parsed)
+        if plan is not None and plan.skip_model:
+            bot_response = self.skipped_response(user_input)
+            self.memory.add_message("Bot", bot_response, parsed[2])
+            self.tracer.finish_turn()
+            return bot_response, parsed[2]
+        max_new_tokens, sampling = self.generation_settings(plan)
+        
+        if self.best_of > 1 and self.model_loader.answer_from_knowledge(parsed[0], parsed[2]) is None:
+            bot_response = self.respond_best_of(user_input, model_prompt, plan)
+            self.memory.add_message("Bot", bot_response, parsed[2])
+            self.tracer.finish_turn()
+            return bot_response, parsed[2]
         
-        # Split into sentences and get coherent ones
-        sentences = []
-        for sent in re.split(r'[.!?]+', response):
-            sent = sent.strip()
-            if sent and len(sent.split()) > 2:  # Only keep sentences with 3+ words
-                sentences.append(sent)
+        # Get bot response with updated history
+        response_tuple = self.model_loader.generate_response(
+            user_input,  # Parsed for the fast path
+            conversation_history=self.memory,  # Pass the updated history
+            max_new_tokens=max_new_tokens,
+            model_prompt=model_prompt,  # What the model continues
+            parsed=parsed,
+            sampling=sampling
+        )
         
-        # Take up to 2 coherent sentences
-        if sentences:
-            response = '. '.join(sentences[:2]) + '.'
+        # Unpack response and query type
+        if isinstance(response_tuple, tuple):
+            bot_response, query_type = response_tuple
         else:
-            response = "I apologize, but I need more context to provide a meaningful response."
+            bot_response, query_type = response_tuple, None
+        
+        # Clean up and validate, falling back if needed
+        bot_response = self.finalize_response(bot_response, user_input, plan if query_type != "error" else None)
+        
+        # Update memory with the bot response and query type
+        self.memory.add_message("Bot", bot_response, query_type)
+        self.tracer.finish_turn()
+        return bot_response, query_type
+    
+    def respond_best_of(self, user_input, model_prompt, plan=None):
+        """
+        Sample best_of candidates in one batched call and keep the best valid one.
+        
+        Falls back to a canned response only when every candidate is invalid.
+        
+        Args:
+            user_input (str): The user's input
+            model_prompt (str): Prompt for the model
+            plan (GenerationPlan): Length and sampling for this turn, if a policy is set
+            
+        Returns:
+            str: The chosen response
+        """
+        max_new_tokens, sampling = self.generation_settings(plan)
+        try:
+            candidates = self.model_loader.generate_candidates(
+                model_prompt, self.best_of, max_new_tokens=max_new_tokens, sampling=sampling
+            )
+        except Exception as e:
+            print(f"Error during text generation: {str(e)}")
+            candidates = []
+        return self.pick_best_candidate(candidates, user_input, plan)
+    
+    def pick_best_candidate(self, candidates, user_input, plan=None):
+        """
+        Clean and score sampled candidates, keeping the best valid one.
+        
+        Args:
+            candidates (list): Raw candidate responses
+            user_input (str): The user's input
+            plan (GenerationPlan): The turn's generation plan, whose outcome is recorded
+            
+        Returns:
+            str: The chosen response, or a fallback if none is valid
+        """
+        best, best_score = None, None
+        for candidate in candidates:
+            cleaned, score = self.response_filter.score(candidate, user_input)
+            if score is not None and (best_score is None or score > best_score):
+                best, best_score = cleaned, score
+        
+        if candidates:
+            # Decoding runs until the longest candidate stops
+            self.record_outcome(plan, max(candidates, key=len), best, best is not None)
+        return best if best is not None else self.generate_fallback_response(user_input)
+    
+    def chat(self, user_input):
+        """
+        Run one complete turn without printing (for scripts and benchmarks).
+        
+        Args:
+            user_input (str): The user's input
+            
+        Returns:
+            tuple: (response text, query type)
+        """
+        model_prompt, parsed = self.begin_turn(user_input)
+        return self.respond(user_input, model_prompt, parsed)
+    
+    def plan_generation(self, user_input, parsed):
+        """
+        Ask the generation policy how to run a turn.
+        
+        Returns:
+            GenerationPlan: None without a policy or when the knowledge base answers the turn
+        """
+        if self.generation_policy is None:
+            return None
+        if self.model_loader.answer_from_knowledge(parsed[0], parsed[2]) is not None:
+            return None
+        return self.generation_policy.plan(parsed[2], user_input)
+    
+    def generation_settings(self, plan):
+        """(max_new_tokens, sampling overrides) for a turn's plan."""
+        if plan is None:
+            return self.max_new_tokens, None
+        return plan.max_new_tokens, plan.sampling
+    
+    def skipped_response(self, user_input):
+        """Fallback given when the policy skips the model for a turn."""
+        self.tracer.count("policy_skips")
+        return self.generate_fallback_response(user_input)
+    
+    def record_outcome(self, plan, raw_response, response, valid):
+        """
+        Report a planned turn's raw response length and validity to the generation policy.
         
-        return response
+        The canned replies that cleanup returns for empty or fragmentary
+        output pass validation but are not answers, so they count as invalid.
         
-        return response
+        Args:
+            plan (GenerationPlan): The turn's plan, or None to record nothing
+            raw_response (str): Model output before cleanup
+            response (str): The cleaned response
+            valid (bool): Whether the cleaned response passed validation
+        """
+        if plan is None or self.generation_policy is None:
+            return
+        answered = valid and response not in (EMPTY_RESPONSE, NO_SENTENCES_RESPONSE)
+        tokens = self.model_loader.count_tokens(raw_response) if raw_response and self.model_loader.is_ready() else 0
+        self.generation_policy.record(plan, answered, tokens)
+    
+    def configure_memory(self):
+        """Switch the memory to token-budgeted prompts once the tokenizer is available."""
+        if self.memory.count_tokens is not None or not self.model_loader.is_ready():
+            return
+        budget = self.memory_tokens
+        if budget is None:
+            window = self.model_loader.context_window()
+            budget = window - self.max_new_tokens if window else None
+        self.memory.set_token_counter(self.model_loader.count_tokens, budget)
+    
+    def show_warming_notice(self, parsed):
+        """Tell the user when a question has to wait for the model to load."""
+        loader = self.model_loader
+        if loader.is_ready():
+            return
+        if loader.answer_from_knowledge(parsed[0], parsed[2]) is not None:
+            return
+        if loader.is_loading():
+            print("(model warming up, one moment...)")
+        elif loader.load_error is not None:
+            print(f"(model unavailable: {loader.load_error})")
+        elif loader.load_on_demand and loader.load_error is None:
+            print(f"(loading {loader.model_name}, one moment...)")
+    
+    def finalize_response(self, response, user_input, plan=None):
+        """
+        Clean a raw response and replace it with a fallback if it is not valid.
+        
+        Args:
+            response (str): Raw response text
+            user_input (str): The user's input
+            plan (GenerationPlan): The turn's generation plan, whose outcome is recorded
+            
+        Returns:
+            str: The response to show and remember
+        """
+        cleaned = self.clean_response(response)
+        valid = self.is_valid_response(cleaned, user_input)
+        self.record_outcome(plan, response, cleaned, valid)
+        if valid:
+            return cleaned
+        return self.generate_fallback_response(user_input)
+    
+    def respond_streaming(self, user_input, model_prompt=None, parsed=None):
+        """
+        Generate, print and remember a response, showing model output as it streams.
+        
+        Args:
+            user_input (str): The user's input
+            model_prompt (str): Prompt for the model, defaults to the user input
+            parsed (tuple): parse_query result for this turn, if already computed
+        """
+        plan = self.plan_generation(user_input, parsed) if parsed is not None else None
+        if plan is not None and plan.skip_model:
+            bot_response = self.skipped_response(user_input)
+            print(f"Bot: {bot_response}\n")
+            self.memory.add_message("Bot", bot_response, parsed[2])
+            self.tracer.finish_turn()
+            return
+        max_new_tokens, sampling = self.generation_settings(plan)
+        
+        chunks, query_type = self.model_loader.stream_response(
+            user_input,
+            conversation_history=self.memory,
+            max_new_tokens=max_new_tokens,
+            model_prompt=model_prompt,
+            parsed=parsed,
+            sampling=sampling
+        )
+        
+        reply = StreamingReply(self, user_input, plan if query_type != "error" else None)
+        try:
+            for chunk in chunks:
+                if reply.feed(chunk):
+                    break
+        finally:
+            # Stops the model at its next token if we stopped reading early
+            if hasattr(chunks, "close"):
+                chunks.close()
+        
+        bot_response = reply.finish()
+        self.memory.add_message("Bot", bot_response, query_type)
+        self.tracer.finish_turn()
+    
+    def clean_partial_response(self, raw):
+        """
+        Clean a response that is still being generated.
+        
+        Args:
+            raw (str): Model output decoded so far
+            
+        Returns:
+            tuple: (displayable text, True if no more output is needed)
+        """
+        return self.response_filter.clean_partial(raw)
+    
+    def is_rejected_partial(self, response, user_input):
+        """
+        Check the parts of is_valid_response that can only get worse as more text arrives.
+        
+        Args:
+            response (str): Cleaned response so far
+            user_input (str): The user's input
+            
+        Returns:
+            bool: True if the response can no longer become valid
+        """
+        return self.response_filter.is_rejected(response.lower(), user_input.lower())
+    
+    def clean_response(self, response):
+        """
+        Clean and format the bot response.
+        
+        Args:
+            response (str): Raw model output
+            
+        Returns:
+            str: Cleaned response
+        """
+        with self.tracer.stage("clean_response"):
+            return self.response_filter.clean(response)
     
     def handle_command(self, command):
         """
@@ -186,8 +696,13 @@ class ChatbotInterface:
         
         if command == "/exit":
             self.exit_chatbot()
+        elif command == "/cancel":
+            print("Nothing to cancel.\n")
+        elif command.startswith("/stats"):
+            self.show_stats(command[len("/stats"):].strip())
         elif command == "/clear":
             self.memory.clear()
+            self.model_loader.reset_cache()
             print("Conversation history cleared.\n")
         elif command == "/help":
             self.display_help()
@@ -195,6 +710,29 @@ class ChatbotInterface:
             print(f"Unknown command: {command}")
             print("Type /help for available commands.\n")
     
+    def show_stats(self, output_format=""):
+        """
+        Print tracing statistics, and the generation policy's per-type statistics.
+        
+        Args:
+            output_format (str): "" for a table, "json" or "prometheus" for a text dump
+        """
+        if not self.tracer.enabled:
+            print("Tracing is off; start the chatbot with trace=True to record stage timings.\n")
+        elif output_format == "json":
+            print(self.tracer.to_json())
+        elif output_format == "prometheus":
+            print(self.tracer.to_prometheus())
+        else:
+            print(self.tracer.format_table())
+            print()
+        if self.generation_policy is not None and output_format in ("", "json"):
+            if output_format == "json":
+                print(json.dumps({"generation_policy": self.generation_policy.get_stats()}, indent=2))
+            else:
+                print(self.generation_policy.format_table())
+                print()
+    
     def is_valid_response(self, response, user_input):
         """
         Validate if the response is appropriate for the input.
@@ -206,48 +744,8 @@ class ChatbotInterface:
         Returns:
             bool: True if the response is valid, False otherwise
         """
-        # Check for minimum length
-        if len(response.split()) < 3:
-            return False
-            
-        # Check if response is just repeating the input
-        if user_input.lower() in response.lower():
-            return False
-            
-        # Check for common meaningless patterns
-        meaningless_patterns = [
-            r'would be the',
-            r'this person',
-            r'no other word',
-            r'or do anyone',
-            r'use your email',
-            r'social media accounts',
-            r'let\'s start by',
-            r'looking at how',
-            r'have to talk about',
-            r'speaking (?:french|spanish|english)',
-            r'interaction has taken',
-            r'need .* assistants',
-            r'someone named',
-            r'different countries'
-        ]
-        
-        import re
-        for pattern in meaningless_patterns:
-            if re.search(pattern, response.lower()):
-                return False
-                
-        # Check for question marks in response to questions
-        if any(w in user_input.lower() for w in ['what', 'where', 'when', 'why', 'how']):
-            if '?' in response:
-                return False
-                
-        # Response shouldn't ask a question when greeting
-        if any(greeting in user_input.lower() for greeting in ['hi', 'hello', 'hey']):
-            if '?' in response:
-                return False
-        
-        return True
+        with self.tracer.stage("is_valid_response"):
+            return self.response_filter.is_valid(response, user_input)
         
     def generate_fallback_response(self, user_input):
         """
@@ -303,9 +801,17 @@ def main():
     """Main entry point for the chatbot application."""
     chatbot = ChatbotInterface(
         model_name="distilgpt2",  # Small, fast model
-        memory_turns=5
+        memory_turns=5,
+        stream=True,              # Show responses as they are generated
+        trace=True,               # Stage timings for /stats
+        generation_policy=GenerationPolicy(),  # Per-type response lengths, also shown by /stats
+        startup="background",     # Prompt appears before the model has loaded
+        warmup_lengths=(16, 64, 256)  # Warmed up in the background too
     )
-    chatbot.run()
+    try:
+        asyncio.run(chatbot.run_async())
+    except KeyboardInterrupt:
+        print("\n\nExiting chatbot. Goodbye!")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,193 @@
+"""
+knowledge_base.py
+Factual answers for the fast path: capitals and places to visit
+"""
+
+from intent_router import normalize_place
+import argparse
+import functools
+import json
+import os
+import sqlite3
+import threading
+
+
+class DictKnowledgeBase:
+    def __init__(self, capital_responses, place_responses):
+        """
+        Knowledge base over in-memory dictionaries (the built-in facts).
+
+        The dictionaries are used as-is, so later edits are visible; call
+        ModelLoader.build_router() after adding multi-word place names.
+
+        Args:
+            capital_responses (dict): Place name -> capital answer
+            place_responses (dict): Place name -> attractions answer
+        """
+        self.capital_responses = capital_responses
+        self.place_responses = place_responses
+        self.max_place_words = max(
+            (len(name.split()) for name in list(capital_responses) + list(place_responses)),
+            default=1
+        )
+
+    def known(self, names):
+        """Return the subset of names that are known places."""
+        return {
+            name for name in names
+            if name in self.capital_responses or name in self.place_responses
+        }
+
+    def capital(self, place):
+        """Capital answer for a place, or None."""
+        return self.capital_responses.get(place)
+
+    def attractions(self, place):
+        """Places-to-visit answer for a place, or None."""
+        return self.place_responses.get(place)
+
+
+class SQLiteKnowledgeBase:
+    def __init__(self, path, cache_size=1024):
+        """
+        Read-only knowledge base stored in SQLite.
+
+        The database is opened on first use and memory-mapped, so resident
+        memory does not grow with the number of places; lookups go through
+        the primary key index and recently used rows are cached.
+
+        Args:
+            path (str): Database file created by SQLiteKnowledgeBase.build
+            cache_size (int): Number of rows kept in the lookup cache
+        """
+        self.path = path
+        self._connection = None
+        self._max_place_words = None
+        self._lock = threading.Lock()
+        self._row = functools.lru_cache(maxsize=cache_size)(self._fetch_row)
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            if not os.path.exists(self.path):
+                raise FileNotFoundError(f"Knowledge base not found: {self.path}")
+            self._connection = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA mmap_size = 268435456")
+        return self._connection
+
+    @property
+    def max_place_words(self):
+        if self._max_place_words is None:
+            with self._lock:
+                row = self.connection.execute(
+                    "SELECT value FROM meta WHERE key = 'max_place_words'"
+                ).fetchone()
+            self._max_place_words = int(row[0]) if row else 1
+        return self._max_place_words
+
+    def _fetch_row(self, place):
+        with self._lock:
+            return self.connection.execute(
+                "SELECT capital, attractions FROM places WHERE name = ?", (place,)
+            ).fetchone()
+
+    def known(self, names):
+        """Return the subset of names that are known places, in one query."""
+        names = list(set(names))
+        if not names:
+            return set()
+        placeholders = ",".join("?" * len(names))
+        with self._lock:
+            rows = self.connection.execute(
+                f"SELECT name FROM places WHERE name IN ({placeholders})", names
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def capital(self, place):
+        """Capital answer for a place, or None."""
+        row = self._row(place)
+        return row[0] if row else None
+
+    def attractions(self, place):
+        """Places-to-visit answer for a place, or None."""
+        row = self._row(place)
+        return row[1] if row else None
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @staticmethod
+    def build(path, records):
+        """
+        Create a knowledge base file from gazetteer records.
+
+        Each record is a dict with a "name" and optionally "capital" (the
+        capital city's name) and "attractions" (a full sentence). Records
+        are streamed, so the input can be larger than memory.
+
+        Args:
+            path (str): Database file to create (replaced if it exists)
+            records (iterable): Gazetteer records
+
+        Returns:
+            int: Number of places written
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        connection = sqlite3.connect(path)
+        connection.execute(
+            "CREATE TABLE places (name TEXT PRIMARY KEY, capital TEXT, attractions TEXT) WITHOUT ROWID"
+        )
+        connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        count = 0
+        max_words = 1
+
+        def rows():
+            nonlocal count, max_words
+            for record in records:
+                name = normalize_place(record["name"])
+                if not name:
+                    continue
+                display = record.get("display_name") or record["name"]
+                capital = record.get("capital")
+                if capital:
+                    capital = f"The capital of {display} is {capital.rstrip('.')}."
+                count += 1
+                max_words = max(max_words, len(name.split()))
+                yield name, capital, record.get("attractions")
+
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO places VALUES (?, ?, ?)", rows())
+            connection.execute(
+                "INSERT INTO meta VALUES ('max_place_words', ?)", (str(max_words),)
+            )
+        connection.execute("VACUUM")
+        connection.close()
+        return count
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def main():
+    """Build a SQLite knowledge base from a JSONL gazetteer."""
+    parser = argparse.ArgumentParser(description="Build a knowledge base for the chatbot")
+    parser.add_argument("gazetteer", help="JSONL file with name/capital/attractions records")
+    parser.add_argument("output", help="SQLite file to create")
+    args = parser.parse_args()
+
+    count = SQLiteKnowledgeBase.build(args.output, read_jsonl(args.gazetteer))
+    print(f"Wrote {count} places to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,92 @@
-﻿from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
-import torch
+﻿from backends import find_snapshot, load_backend_model, mark_snapshot
+from chat_memory import ChatMemory, ConversationIndex, Message
+from model_registry import SharedModel, current_rss_mb, peak_rss_mb, registry
+from intent_router import IntentRouter
+from knowledge_base import DictKnowledgeBase
+from response_filters import ResponseFilter
+from tracing import Tracer
+import asyncio
+import contextvars
+import functools
+import threading
+import time
 import traceback
 import random
 
+# transformers and torch are imported where they are first needed, so the
+# chatbot can start (and answer from the knowledge base) before they load.
+
+# Repeated to build warm-up prompts of a given length
+WARMUP_TEXT = "The quick brown fox jumps over the lazy dog while the assistant answers a question. "
+
+
 class ModelLoader:
-    def __init__(self, model_name="gpt2"):
+    def __init__(self, model_name="gpt2", knowledge_base=None, response_cache=None, backend="pytorch",
+                 draft_model_name=None, num_assistant_tokens=5, tracer=None, snapshot_dir=None,
+                 warmup_lengths=None, response_filter=None, dtype=None, shared=True):
         self.model_name = model_name
-        self.device = 0 if torch.cuda.is_available() else -1
+        # Weight precision ("float16", "bfloat16"), float32 by default
+        self.dtype = dtype
+        # Share one loaded copy of the model with other loaders in this process
+        self.shared = shared
+        self._shared_key = None
+        self._shared_model = None
+        # Decoding stops once the output is a finished turn by these rules
+        # (a speaker label or max_sentences sentences), or at a line break
+        self.response_filter = response_filter or ResponseFilter()
+        self.stop_on_text = True
+        self.stop_at_newline = True
+        # Directory holding a safetensors (or ONNX) copy of the weights for fast restarts
+        self.snapshot_dir = snapshot_dir
+        # Prompt lengths (in tokens) of the dummy generations run after loading
+        self.warmup_lengths = warmup_lengths
+        # Cold start timings, filled in by load_model and warm_up
+        self.startup_stats = {}
+        # Per-stage timings and hit counters; disabled unless a tracer is given
+        self.tracer = tracer or Tracer()
+        # Inference backend: "pytorch", "int8", "compile" or "onnx" (see backends.py)
+        self.backend = backend
+        # Optional small model that drafts tokens for the main model to verify
+        self.draft_model_name = draft_model_name
+        self.num_assistant_tokens = num_assistant_tokens
+        self.draft_model = None
+        self.speculative_stats = {
+            "generations": 0,
+            "new_tokens": 0,
+            "target_forwards": 0,
+            "draft_tokens": 0,
+            "accepted_tokens": 0
+        }
+        # Forward-pass counting hook on the draft model
+        self._draft_hook = None
+        self.device = None
         self.generator = None
         self.tokenizer = None
         self.current_context = None
+        # Background loading state (see start_loading)
+        self.load_on_demand = False
+        self.load_error = None
+        self._load_thread = None
+        self._load_lock = threading.Lock()
+        # True while load_model runs the warm-up; the model is not ready until it ends
+        self._warming = False
+        # (token ids, past_key_values) of the last generation, reused when the
+        # next prompt starts with the same tokens
+        self.prefix_cache = None
+        self.generation_stats = {"reused_tokens": 0, "prefilled_tokens": 0, "generated_tokens": 0}
+        # Fast tokenizers are not thread-safe, so every tokenizer and model
+        # call holds this lock (reentrant; count_tokens uses its own tokenizer
+        # and lock). Once loaded it is the model's own lock, shared with other
+        # loaders of it
+        self._generate_lock = threading.RLock()
+        self.generation_kwargs = {
+            "do_sample": True,
+            "temperature": 0.3,
+            "top_p": 0.85,
+            "top_k": 20,
+            "repetition_penalty": 1.5,
+            "no_repeat_ngram_size": 3
+        }
         self.factual_responses = {
             "capital_responses": {
                 "france": "The capital of France is Paris.",
@@ -42,81 +119,522 @@ class ModelLoader:
                 "Greetings! How may I help you?"
             ]
         }
+        # Backend for capital/places answers; defaults to the built-in facts
+        self.knowledge_base = knowledge_base or DictKnowledgeBase(
+            self.factual_responses["capital_responses"],
+            self.factual_responses["place_responses"]
+        )
+        self.build_router()
+        # Optional ResponseCache consulted before the model is run
+        self.response_cache = response_cache
+
+    def load_model(self, verbose=True):
+        """
+        Load the tokenizer and model, or take them from the process-wide registry.
+
+        Loaders with the same model name, backend, device, dtype and snapshot
+        directory share one copy of the weights unless created with
+        shared=False. Resident memory after the load and its peak so far are
+        kept in startup_stats.
+        """
+        started = time.perf_counter()
+        from transformers import pipeline, AutoTokenizer
+        import torch
+        imported = time.perf_counter()
 
-    def load_model(self):
-        print(f"Loading model: {self.model_name}...")
         try:
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-            if self.tokenizer.pad_token is None:
-                self.tokenizer.pad_token = self.tokenizer.eos_token
+            # Quantized and ONNX Runtime models run on CPU
+            use_gpu = torch.cuda.is_available() and self.backend not in ("int8", "onnx")
+            self.device = 0 if use_gpu else -1
+
+            def load():
+                if verbose:
+                    print(f"Loading model: {self.model_name} ({self.backend} backend)...")
+                # A complete snapshot is loaded instead of the original weights
+                snapshot = find_snapshot(self.snapshot_dir, self.model_name, self.backend, self.dtype)
+                source = snapshot or self.model_name
+                tokenizer = AutoTokenizer.from_pretrained(source)
+                if tokenizer.pad_token is None:
+                    tokenizer.pad_token = tokenizer.eos_token
+                # Decoder-only models must be left-padded for batched generation
+                tokenizer.padding_side = "left"
+
+                save_to = self.snapshot_dir if self.snapshot_dir and not snapshot else None
+                model = load_backend_model(source, self.backend, self.device, snapshot_dir=save_to, dtype=self.dtype)
+                if save_to:
+                    tokenizer.save_pretrained(save_to)
+                    mark_snapshot(save_to, self.model_name, self.backend, self.dtype)
+                # The pipeline gets the model object, so the weights are not resolved a second time
+                if self.backend == "onnx":
+                    generator = pipeline("text-generation", model=model, tokenizer=tokenizer)
+                else:
+                    generator = pipeline("text-generation", model=model, tokenizer=tokenizer, device=self.device)
+                return SharedModel(tokenizer, generator, "loaded" if snapshot else "saved" if save_to else None)
+
+            if self._shared_model is not None:
+                self.release_model()
+            if self.shared:
+                key = (self.model_name, self.backend, self.device, self.dtype, self.snapshot_dir)
+                shared_model, reused = registry.acquire(key, load)
+                self._shared_key = key
+            else:
+                shared_model, reused = load(), False
+            self._shared_model = shared_model
+            self._generate_lock = shared_model.lock
+            self.tokenizer = shared_model.tokenizer
+            self.generator = shared_model.generator
             
-            self.generator = pipeline(
-                "text-generation",
-                model=self.model_name,
-                tokenizer=self.tokenizer,
-                device=self.device
-            )
+            if self.draft_model_name:
+                self.load_draft_model(verbose)
             
-            if self.device == -1:
-                print("Device set to use CPU")
-            print("Model loaded successfully!")
+            self.startup_stats.update({
+                "import_seconds": imported - started,
+                "load_seconds": time.perf_counter() - imported,
+                "snapshot": shared_model.snapshot,
+                "shared": reused,
+                "dtype": self.dtype or "float32",
+                "rss_mb": current_rss_mb(),
+                "peak_rss_mb": peak_rss_mb()
+            })
+            if verbose:
+                if self.device == -1:
+                    print("Device set to use CPU")
+                if reused:
+                    print(f"Using the already loaded {self.model_name} model")
+                else:
+                    source_note = {"loaded": " from snapshot", "saved": ", snapshot saved"}.get(
+                        shared_model.snapshot, ""
+                    )
+                    print(f"Model loaded successfully in {time.perf_counter() - started:.1f}s{source_note}!")
+                rss, peak = self.startup_stats["rss_mb"], self.startup_stats["peak_rss_mb"]
+                if rss is not None and peak is not None:
+                    print(f"Memory: {rss:.0f} MB resident, {peak:.0f} MB peak")
+            
+            # A shared model only needs warming up once
+            if self.warmup_lengths and not shared_model.warmed_up:
+                self._warming = True
+                try:
+                    self.warm_up(self.warmup_lengths, verbose=verbose)
+                finally:
+                    self._warming = False
+                shared_model.warmed_up = True
             return self.generator
             
         except Exception as e:
-            print(f"Error loading model: {str(e)}")
-            print(traceback.format_exc())
+            if verbose:
+                print(f"Error loading model: {str(e)}")
+                print(traceback.format_exc())
             raise
 
+    def release_model(self):
+        """Stop using the model; a shared one is freed once its last loader releases it."""
+        shared_model, self._shared_model = self._shared_model, None
+        last_user = registry.release(self._shared_key) if self._shared_key is not None else True
+        self._shared_key = None
+        if last_user and shared_model is not None and shared_model.forward_hook is not None:
+            shared_model.forward_hook.remove()
+            shared_model.forward_hook = None
+        if self._draft_hook is not None:
+            self._draft_hook.remove()
+            self._draft_hook = None
+        self.generator = None
+        self.tokenizer = None
+        self.draft_model = None
+        self.reset_cache()
+
+    def load_draft_model(self, verbose=True):
+        """
+        Load the draft model for speculative (assisted) decoding.
+
+        The draft proposes num_assistant_tokens tokens at a time and the main
+        model verifies them in one forward pass. Both must share a tokenizer.
+        """
+        from generation_helpers import count_forward_calls
+
+        if self.backend == "onnx":
+            raise ValueError("Speculative decoding is not supported with the onnx backend")
+        if verbose:
+            print(f"Loading draft model: {self.draft_model_name}...")
+
+        target = self.generator.model
+        draft = load_backend_model(self.draft_model_name, "pytorch", self.device, dtype=self.dtype).to(target.device)
+        if draft.config.vocab_size != target.config.vocab_size:
+            raise ValueError(
+                f"Draft model {self.draft_model_name} does not share the vocabulary of {self.model_name}"
+            )
+        draft.generation_config.num_assistant_tokens = self.num_assistant_tokens
+        # Keep the draft length fixed so acceptance rates are comparable when tuning
+        draft.generation_config.num_assistant_tokens_schedule = "constant"
+
+        # One hook per model; a shared target may already count for another loader
+        if self._shared_model.forward_hook is None:
+            self._shared_model.forward_hook = count_forward_calls(target, "target")
+        if self._draft_hook is not None:
+            self._draft_hook.remove()
+        self._draft_hook = count_forward_calls(draft, "draft")
+        self.draft_model = draft
+        return draft
+
+    def warm_up(self, prompt_lengths=(16, 64, 256), max_new_tokens=8, verbose=True):
+        """
+        Run dummy generations so the first real query does not pay for lazy initialization.
+
+        Each prompt length is first generated for a single token, which
+        times the cold first-token latency at that length, then for
+        max_new_tokens to warm the decoding path. Lengths that do not fit the
+        context window are skipped. Warm-up is not traced and does not count
+        towards generation_stats. It holds the generation lock throughout;
+        when run by load_model, is_ready() stays False until it ends, so turns
+        that do not need the model are answered meanwhile without waiting.
+
+        Args:
+            prompt_lengths (iterable): Prompt lengths in tokens
+            max_new_tokens (int): Tokens generated per warm-up prompt
+            verbose (bool): Print a summary
+
+        Returns:
+            dict: Warm-up timings (also kept in startup_stats)
+        """
+        started = time.perf_counter()
+        with self._generate_lock:
+            saved_cache = self.prefix_cache
+            filler = self.tokenizer.encode(WARMUP_TEXT)
+            window = self.context_window()
+            first_token = {}
+            try:
+                for length in prompt_lengths:
+                    if window and length + max_new_tokens > window:
+                        continue
+                    prompt = self.tokenizer.decode((filler * (length // len(filler) + 1))[:length])
+                    self.prefix_cache = None
+                    start = time.perf_counter()
+                    self._generate_ids(prompt, 1, stop_on_text=False, record=False)
+                    first_token[length] = time.perf_counter() - start
+                    # Continues from the cached prompt, warming the prefix-reuse path too
+                    self._generate_ids(prompt, max_new_tokens, stop_on_text=False, record=False)
+                if first_token:
+                    # The same measurement once warm, for comparison
+                    length = min(first_token)
+                    prompt = self.tokenizer.decode((filler * (length // len(filler) + 1))[:length])
+                    self.prefix_cache = None
+                    start = time.perf_counter()
+                    self._generate_ids(prompt, 1, stop_on_text=False, record=False)
+                    warm_first_token = time.perf_counter() - start
+                else:
+                    warm_first_token = None
+            finally:
+                self.prefix_cache = saved_cache
+
+        stats = {
+            "warmup_seconds": time.perf_counter() - started,
+            "cold_first_token_seconds": first_token,
+            "warm_first_token_seconds": warm_first_token
+        }
+        self.startup_stats.update(stats)
+        if verbose and first_token:
+            cold = ", ".join(f"{length} tokens {seconds * 1000:.0f}ms" for length, seconds in first_token.items())
+            print(f"Warm-up done in {stats['warmup_seconds']:.1f}s. First token when cold: {cold}; "
+                  f"when warm: {warm_first_token * 1000:.0f}ms at {min(first_token)} tokens.")
+        return stats
+
+    def speculative_report(self):
+        """
+        Acceptance statistics of speculative decoding, for tuning the draft length.
+
+        Each verification pass of the main model adds the accepted draft
+        tokens plus one of its own, so accepted = new tokens - verification passes.
+        """
+        stats = dict(self.speculative_stats)
+        stats["num_assistant_tokens"] = self.num_assistant_tokens
+        stats["acceptance_rate"] = (
+            stats["accepted_tokens"] / stats["draft_tokens"] if stats["draft_tokens"] else None
+        )
+        stats["tokens_per_target_forward"] = (
+            stats["new_tokens"] / stats["target_forwards"] if stats["target_forwards"] else None
+        )
+        return stats
+
+    def start_loading(self):
+        """
+        Import the model libraries and load the model in a background thread.
+
+        Knowledge-base answers keep working meanwhile; generation waits for
+        the load to finish (see ensure_model).
+        """
+        def load():
+            try:
+                self.load_model(verbose=False)
+            except Exception as e:
+                self.load_error = e
+
+        with self._load_lock:
+            if self.generator is None and self._load_thread is None:
+                self._load_thread = threading.Thread(target=load, daemon=True)
+                self._load_thread.start()
+        return self._load_thread
+
+    def is_ready(self):
+        """True once the model is loaded and warmed up."""
+        return self.generator is not None and not self._warming
+
+    def is_loading(self):
+        """True while a background load is in progress."""
+        return self._load_thread is not None and self._load_thread.is_alive()
+
+    def ensure_model(self):
+        """
+        Make sure the model is available for generation.
+
+        Waits for a background load in progress, or loads the model now when
+        load_on_demand is set.
+
+        Returns:
+            bool: True if the model is loaded
+        """
+        if self.is_ready():
+            return True
+        if self._load_thread is not None:
+            self._load_thread.join()
+        elif self.generator is None and self.load_on_demand and self.load_error is None:
+            try:
+                self.load_model(verbose=False)
+            except Exception as e:
+                self.load_error = e
+        return self.generator is not None
+
+    def context_window(self):
+        """Maximum number of tokens the loaded model can attend to, or None before loading."""
+        if self.generator is None:
+            return None
+        config = self.generator.model.config
+        return getattr(config, "max_position_embeddings", None) or getattr(config, "n_positions", None)
+
+    def count_tokens(self, text):
+        """Number of tokens text encodes to, without waiting for generations in progress."""
+        shared_model = self._shared_model
+        with shared_model.counting_lock:
+            return len(shared_model.counting_tokenizer.encode(text))
+
+    def reset_cache(self):
+        """Drop the cached key/values of the previous prompt."""
+        with self._generate_lock:
+            self.prefix_cache = None
+
+    def _reusable_cache(self, input_ids):
+        """
+        Take the cached key/values covering the longest prefix shared with input_ids.
+
+        At least one input token is always left uncached so generate() has
+        something to prefill. Returns None when nothing can be reused.
+        """
+        if self.prefix_cache is None or self.backend == "onnx":
+            # ONNX Runtime models manage their own cache format
+            return None
+        cached_ids, past_key_values = self.prefix_cache
+        # generate() extends the cache in place, so it is handed over, not shared
+        self.prefix_cache = None
+
+        common = 0
+        for cached, new in zip(cached_ids, input_ids):
+            if cached != new:
+                break
+            common += 1
+        common = min(common, len(input_ids) - 1)
+        if common <= 0:
+            return None
+        from generation_helpers import crop_cache
+        return crop_cache(past_key_values, common)
+
+    def is_turn_finished(self, text):
+        """
+        True once generated text holds a complete response.
+
+        That is a speaker label (the model has started the next turn), a line
+        break after some text (every turn in the prompt is one line), or the
+        filter's max_sentences complete sentences. Nothing generated after
+        that point would survive cleanup.
+        """
+        if self.stop_at_newline and "\n" in text.lstrip():
+            return True
+        # The last word is complete for this check: a closing "." ends its sentence now
+        return self.response_filter.clean_partial(text + " ")[1]
+
+    def _text_stopping_criteria(self, prompt_length, criteria=None):
+        """Add a StopOnText criterion for prompts of prompt_length tokens to criteria."""
+        from transformers import StoppingCriteriaList
+        from generation_helpers import StopOnText
+
+        criteria = StoppingCriteriaList(criteria or [])
+        criteria.append(StopOnText(self.tokenizer, prompt_length, self.is_turn_finished))
+        return criteria
+
+    def _generate_ids(self, prompt, max_new_tokens, stop_on_text=None, sampling=None, record=True, **kwargs):
+        """
+        Generate a continuation of prompt, prefilling only tokens not already cached.
+
+        Unless stop_on_text is False (it defaults to self.stop_on_text),
+        decoding stops as soon as the output is a finished turn. sampling
+        overrides generation_kwargs for this call. With record=False (used by
+        warm-up) nothing is traced or added to the generation statistics.
+
+        Returns:
+            torch.Tensor: The newly generated token ids
+        """
+        from generation_helpers import cache_length, counting_forward_calls, supports_prefix_reuse
+
+        model = self.generator.model
+        tracer = self.tracer if record else Tracer()
+        with self._generate_lock:
+            with tracer.stage("tokenize"):
+                encoded = self.tokenizer(prompt, return_tensors="pt", truncation=True)
+            input_ids = encoded["input_ids"]
+            ids = input_ids[0].tolist()
+            if self.draft_model is not None:
+                # Assisted generation manages the caches of both models itself
+                kwargs["assistant_model"] = self.draft_model
+                self.prefix_cache = None
+                past_key_values = None
+            else:
+                past_key_values = self._reusable_cache(ids)
+            reused = cache_length(past_key_values) if past_key_values is not None else 0
+            if record:
+                self.generation_stats["reused_tokens"] += reused
+                self.generation_stats["prefilled_tokens"] += len(ids) - reused
+            tracer.count("reused_tokens", reused)
+            tracer.count("prefilled_tokens", len(ids) - reused)
+            if self.stop_on_text if stop_on_text is None else stop_on_text:
+                kwargs["stopping_criteria"] = self._text_stopping_criteria(
+                    len(ids), kwargs.get("stopping_criteria")
+                )
+
+            # Forward passes of this call only, whatever other loaders of the model run
+            forwards = {"target": 0, "draft": 0}
+            with tracer.stage("generate"), counting_forward_calls(forwards):
+                output = model.generate(
+                    input_ids=input_ids.to(model.device),
+                    attention_mask=encoded["attention_mask"].to(model.device),
+                    past_key_values=past_key_values,
+                    max_new_tokens=max_new_tokens,
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    use_cache=True,
+                    return_dict_in_generate=True,
+                    **self.sampling_kwargs(sampling),
+                    **kwargs
+                )
+
+            sequence = output.sequences[0]
+            new_tokens = len(sequence) - len(ids)
+            if record:
+                self.generation_stats["generated_tokens"] += new_tokens
+            tracer.count("generated_tokens", new_tokens)
+            if new_tokens < max_new_tokens:
+                tracer.count("early_stops")
+            if self.draft_model is not None:
+                if record:
+                    target_forwards = forwards["target"]
+                    stats = self.speculative_stats
+                    stats["generations"] += 1
+                    stats["new_tokens"] += new_tokens
+                    stats["target_forwards"] += target_forwards
+                    stats["draft_tokens"] += forwards["draft"]
+                    stats["accepted_tokens"] += max(new_tokens - target_forwards, 0)
+                return sequence[len(ids):]
+            if output.past_key_values is not None and supports_prefix_reuse():
+                cached = cache_length(output.past_key_values)
+                self.prefix_cache = (sequence[:cached].tolist(), output.past_key_values)
+            return sequence[len(ids):]
+
+    def _stopping_criteria(self, *events):
+        """Stopping criteria that end generation once any of the given events is set."""
+        from transformers import StoppingCriteriaList
+        from generation_helpers import StopOnEvent
+
+        events = [event for event in events if event is not None]
+        return StoppingCriteriaList([StopOnEvent(event) for event in events]) if events else None
+
+    def build_router(self):
+        """Compile the intent matcher over the knowledge base's places."""
+        self.router = IntentRouter(self.knowledge_base)
+        return self.router
+
+    def find_place(self, text):
+        """Place mentioned in lowercase text, or None."""
+        return self.router.find_place(text)
+
+    def history_index(self, conversation_history):
+        """
+        The ConversationIndex of a conversation.
+
+        A ChatMemory keeps its index up to date as messages are added (its
+        place finder is set here on first use); a plain sequence of messages
+        ({"role", "message", "query_type"} dicts or Message objects) is
+        indexed on the spot, without modifying its entries.
+        """
+        if isinstance(conversation_history, ChatMemory):
+            if conversation_history.place_finder is None:
+                conversation_history.set_place_finder(self.find_place)
+            return conversation_history.index
+        index = ConversationIndex()
+        for entry in conversation_history or ():
+            if isinstance(entry, dict):
+                entry = Message(entry["role"], entry["message"], entry.get("query_type"))
+            else:
+                entry = Message(entry.role, entry.message, entry.query_type)
+            entry.place = self.find_place(entry.message.lower())
+            index.add(entry)
+        return index
+
     def parse_query(self, user_input, conversation_history=None):
+        """
+        Work out the topic and query type of the user's input.
+
+        Args:
+            user_input (str): The user's input
+            conversation_history: ChatMemory of the conversation so far (or a
+                sequence of its messages), for follow-up questions
+
+        Returns:
+            tuple: (topic, context, query_type)
+        """
+        with self.tracer.stage("parse_query"):
+            return self._parse_query(user_input, conversation_history)
+
+    def _parse_query(self, user_input, conversation_history=None):
         try:
             user_input = user_input.lower().strip()
-            places = list(self.factual_responses["capital_responses"].keys()) + ["paris", "rome"]
+            intents = self.router.intents(user_input)
             
-            if any(greeting in user_input for greeting in ["hi", "hello", "hey"]):
+            if "greeting" in intents:
                 return None, None, "greeting"
             
-            followup_words = ["what about", "how about", "what of", "and", "what is"]
-            there_words = ["there", "that place", "that country", "it"]
-            is_followup = any(word in user_input for word in followup_words)
-            is_there_reference = any(word in user_input for word in there_words)
+            is_followup = "followup" in intents
+            is_there_reference = "there" in intents
             
-            mentioned_place = next((place for place in places if place in user_input), None)
+            mentioned_place = self.router.find_place(user_input)
             
             if is_there_reference and self.current_context and not mentioned_place:
                 mentioned_place = self.current_context
-                mentioned_place = self.current_context
             
-            is_capital = any(word in user_input for word in ["capital", "capitol"])
-            is_places = any(word in user_input for word in [
-                "visit", "places", "attractions", "see", "where", 
-                "tell me about", "things", "tourists"
-            ])
+            is_capital = "capital" in intents
+            is_places = "places" in intents
+            
+            # Facts about the history come from its index, not a scan
+            index = self.history_index(conversation_history)
             
-            if (is_followup or is_there_reference) and conversation_history:
+            if (is_followup or is_there_reference) and index.messages:
                 last_query_type = None
-                last_place = mentioned_place or self.current_context
+                last_place = mentioned_place or self.current_context or index.last_place
                 
-                for entry in reversed(conversation_history):
-                    if isinstance(entry, dict) and entry.get("message"):
-                        msg = entry["message"].lower()
-                        entry_type = entry.get("query_type")
-                        
-                        # Only set the last_query_type if we don't have an explicit type
-                        if not (is_capital or is_places):
-                            if entry_type == "capital":
-                                last_query_type = "capital"
-                                if last_place:  # If we have a place, we can stop
-                                    break
-                            elif not last_query_type and entry_type:
-                                last_query_type = entry_type
-                            
-                        if not last_place:
-                            for place in places:
-                                if place in msg.lower():
-                                    last_place = place
-                                    self.current_context = place
-                                    if entry_type == "capital":  # Perfect match!
-                                        break
+                # Only use the history's type if we don't have an explicit type
+                if not (is_capital or is_places):
+                    if index.capitals_in_window:
+                        last_query_type = "capital"
+                    elif mentioned_place:
+                        # A named place is a topic question; a general turn in
+                        # between ("tell me a joke") does not make it general
+                        last_query_type = index.last_topic_type or "places"
+                    else:
+                        last_query_type = index.last_query_type
                                         
                 if last_place:
                     self.current_context = last_place
@@ -136,14 +654,7 @@ class ModelLoader:
                 elif is_places:
                     return mentioned_place, mentioned_place, "places"
                 else:
-                    if conversation_history:
-                        for entry in reversed(conversation_history):
-                            if isinstance(entry, dict):
-                                if entry.get("query_type") == "capital":
-                                    return mentioned_place, mentioned_place, "capital"
-                                elif entry.get("query_type") == "places":
-                                    return mentioned_place, mentioned_place, "places"
-                    return mentioned_place, mentioned_place, "places"
+                    return mentioned_place, mentioned_place, index.last_topic_type or "places"
             
             return None, None, "general"
             
@@ -152,49 +663,113 @@ class ModelLoader:
             print(traceback.format_exc())
             return None, None, "general"
 
-    def generate_response(self, prompt, conversation_history=None, max_new_tokens=50):
+    def answer_from_knowledge(self, topic, query_type):
+        """Return a canned answer for greetings and known facts, or None on a miss."""
+        if query_type == "greeting":
+            return random.choice(self.factual_responses["greetings"])
+
+        if query_type == "capital" and topic:
+            return self.knowledge_base.capital(topic)
+
+        if query_type == "places" and topic:
+            return self.knowledge_base.attractions(topic)
+
+        return None
+
+    def _lookup(self, prompt, model_prompt, topic, query_type, max_new_tokens, sampling=None):
+        """Answer from the knowledge base or the response cache, counting hits; None on a miss."""
+        tracer = self.tracer
+        with tracer.stage("knowledge_base"):
+            answer = self.answer_from_knowledge(topic, query_type)
+        if answer is not None:
+            tracer.count("knowledge_base_hits")
+            return answer
+        tracer.count("knowledge_base_misses")
+
+        if self.response_cache is not None:
+            with tracer.stage("response_cache"):
+                cached = self.response_cache.get(prompt, model_prompt, self.cache_params(max_new_tokens, sampling))
+            tracer.count("response_cache_hits" if cached is not None else "response_cache_misses")
+            return cached
+        return None
+
+    def sampling_kwargs(self, sampling=None):
+        """generation_kwargs with a turn's overrides (e.g. from a GenerationPolicy) applied."""
+        return dict(self.generation_kwargs, **sampling) if sampling else self.generation_kwargs
+
+    def cache_params(self, max_new_tokens, sampling=None):
+        """Everything besides the prompt that a cached response depends on."""
+        return dict(self.sampling_kwargs(sampling), model=self.model_name, max_new_tokens=max_new_tokens)
+
+    def cache_response(self, prompt, model_prompt, params, response):
+        """
+        Cache a generated response, cleaned, if it passes validation.
+
+        An invalid sample is not stored, so it is not replayed to every later
+        asker of the same question; the fallback it would get is chosen anew.
+
+        Args:
+            prompt (str): The user's input
+            model_prompt (str): The text the model continued
+            params (dict): cache_params of the generation
+            response (str): Raw generated text
+        """
+        if self.response_cache is None or not response:
+            return
+        cleaned, score = self.response_filter.score(response, prompt)
+        if score is not None:
+            self.response_cache.put(prompt, model_prompt, params, cleaned)
+
+    def generate_response(self, prompt, conversation_history=None, max_new_tokens=50, model_prompt=None, parsed=None,
+                          cancel_event=None, sampling=None):
+        """
+        Answer prompt from the knowledge base or, on a miss, the model.
+
+        model_prompt is the text the model continues (e.g. the conversation
+        so far); it defaults to prompt. Consecutive model prompts that share a
+        prefix reuse its cached key/values. parsed is a parse_query result
+        already computed for this turn, so the input is not parsed twice.
+        With a response_cache set, cached responses are returned instead of
+        running the model. Setting cancel_event (a threading.Event) from
+        another thread stops the model at its next token; a cancelled
+        response is not cached. sampling overrides generation_kwargs for
+        this turn.
+        """
         try:
             if not prompt or not isinstance(prompt, str):
                 return "I'm sorry, I didn't receive a valid question. Could you please rephrase?", "error"
 
-            topic, context, query_type = self.parse_query(prompt, conversation_history)
-            
-            if query_type == "greeting":
-                return random.choice(self.factual_responses["greetings"]), query_type
-            
-            if query_type == "capital" and topic:
-                if topic in self.factual_responses["capital_responses"]:
-                    return self.factual_responses["capital_responses"][topic], query_type
-            
-            if query_type == "places" and topic:
-                if topic in self.factual_responses["place_responses"]:
-                    return self.factual_responses["place_responses"][topic], query_type
-            
-            if self.generator is None:
+            if parsed is None:
+                parsed = self.parse_query(prompt, conversation_history)
+            topic, context, query_type = parsed
+
+            answer = self._lookup(prompt, model_prompt, topic, query_type, max_new_tokens, sampling)
+            if answer is not None:
+                return answer, query_type
+
+            if not self.ensure_model():
                 return "I apologize, but I need the model to be loaded first. Please try again.", "error"
 
             try:
-                response = self.generator(
-                    prompt,
-                    max_new_tokens=max_new_tokens,
-                    num_return_sequences=1,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    do_sample=True,
-                    temperature=0.3,
-                    top_p=0.85,
-                    top_k=20,
-                    repetition_penalty=1.5,
-                    truncation=True,
-                    clean_up_tokenization_spaces=True,
-                    no_repeat_ngram_size=3
-                )
-                
-                generated_text = response[0]["generated_text"]
-                if generated_text.startswith(prompt):
-                    generated_text = generated_text[len(prompt):].strip()
+                kwargs = {}
+                if cancel_event is not None:
+                    kwargs["stopping_criteria"] = self._stopping_criteria(cancel_event)
+                new_ids = self._generate_ids(model_prompt or prompt, max_new_tokens, sampling=sampling, **kwargs)
+                with self._generate_lock, self.tracer.stage("decode"):
+                    generated_text = self.tokenizer.decode(
+                        new_ids,
+                        skip_special_tokens=True,
+                        clean_up_tokenization_spaces=True
+                    ).strip()
                 
-                final_response = generated_text or "I'm not sure how to answer that. Could you please rephrase?"
-                return final_response, query_type
+                if not generated_text:
+                    return "I'm not sure how to answer that. Could you please rephrase?", query_type
+                cancelled = cancel_event is not None and cancel_event.is_set()
+                if not cancelled:
+                    self.cache_response(
+                        prompt, model_prompt, self.cache_params(max_new_tokens, sampling), generated_text
+                    )
+                return generated_text, query_type
                 
             except Exception as e:
                 print(f"Error during text generation: {str(e)}")
@@ -205,3 +780,254 @@ class ModelLoader:
             print(f"Error generating response: {str(e)}")
             print(traceback.format_exc())
             return "I apologize, but I encountered an error. Could you try asking again?", "error"
+
+    def generate_batch(self, prompts, max_new_tokens=50):
+        """
+        Generate continuations for several prompts in one padded generator call.
+
+        Args:
+            prompts (list): Model prompts
+            max_new_tokens (int): Maximum tokens to generate per prompt
+
+        Returns:
+            list: Generated text for each prompt, in order
+        """
+        prompts = list(prompts)
+        kwargs = {}
+        with self._generate_lock, self.tracer.stage("generate_batch"):
+            if self.stop_on_text:
+                # Prompts are left-padded to the longest, where generation starts for all of them
+                encoded = self.tokenizer(prompts, truncation=True)["input_ids"]
+                kwargs["stopping_criteria"] = self._text_stopping_criteria(max(len(ids) for ids in encoded))
+            outputs = self.generator(
+                prompts,
+                max_new_tokens=max_new_tokens,
+                num_return_sequences=1,
+                pad_token_id=self.tokenizer.eos_token_id,
+                truncation=True,
+                clean_up_tokenization_spaces=True,
+                return_full_text=False,
+                batch_size=len(prompts),
+                **self.generation_kwargs,
+                **kwargs
+            )
+        return [output[0]["generated_text"].strip() for output in outputs]
+
+    def generate_candidates(self, prompt, num_candidates, max_new_tokens=50, cancel_event=None, sampling=None):
+        """
+        Sample several continuations of one prompt in a single batched call.
+
+        The prompt is prefilled once and the candidates are decoded side by
+        side, which costs far less than num_candidates separate generations.
+
+        Args:
+            prompt (str): Model prompt
+            num_candidates (int): Number of continuations to sample
+            max_new_tokens (int): Maximum tokens to generate per candidate
+            cancel_event (threading.Event): Stops all candidates at their next token once set
+            sampling (dict): Overrides of generation_kwargs for this call
+
+        Returns:
+            list: Generated text of each candidate (empty if the model is unavailable)
+        """
+        if not self.ensure_model():
+            return []
+        kwargs = {}
+        if cancel_event is not None:
+            kwargs["stopping_criteria"] = self._stopping_criteria(cancel_event)
+        with self._generate_lock, self.tracer.stage("generate_candidates"):
+            if self.stop_on_text:
+                prompt_length = len(self.tokenizer(prompt, truncation=True)["input_ids"])
+                kwargs["stopping_criteria"] = self._text_stopping_criteria(
+                    prompt_length, kwargs.get("stopping_criteria")
+                )
+            outputs = self.generator(
+                prompt,
+                max_new_tokens=max_new_tokens,
+                num_return_sequences=num_candidates,
+                pad_token_id=self.tokenizer.eos_token_id,
+                truncation=True,
+                clean_up_tokenization_spaces=True,
+                return_full_text=False,
+                **self.sampling_kwargs(sampling),
+                **kwargs
+            )
+        return [output["generated_text"].strip() for output in outputs]
+
+    def stream_response(self, prompt, conversation_history=None, max_new_tokens=50, model_prompt=None, parsed=None,
+                        cancel_event=None, sampling=None):
+        """
+        Streaming variant of generate_response.
+
+        Returns a (chunks, query_type) tuple where chunks is an iterator of
+        decoded text pieces. Fast-path answers arrive as a single chunk; model
+        output arrives token by token as it is decoded. Closing the iterator
+        early stops the model at its next token, as does setting cancel_event;
+        a cancelled response is not cached.
+        """
+        try:
+            if not prompt or not isinstance(prompt, str):
+                return iter(["I'm sorry, I didn't receive a valid question. Could you please rephrase?"]), "error"
+
+            if parsed is None:
+                parsed = self.parse_query(prompt, conversation_history)
+            topic, context, query_type = parsed
+
+            answer = self._lookup(prompt, model_prompt, topic, query_type, max_new_tokens, sampling)
+            if answer is not None:
+                return iter([answer]), query_type
+
+            if not self.ensure_model():
+                return iter(["I apologize, but I need the model to be loaded first. Please try again."]), "error"
+
+            from transformers import TextIteratorStreamer
+
+            streamer = TextIteratorStreamer(
+                self.tokenizer,
+                skip_prompt=True,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=True
+            )
+            stop_event = threading.Event()
+            failed = threading.Event()
+
+            def run_generation():
+                try:
+                    self._generate_ids(
+                        model_prompt or prompt,
+                        max_new_tokens,
+                        streamer=streamer,
+                        sampling=sampling,
+                        stopping_criteria=self._stopping_criteria(stop_event, cancel_event)
+                    )
+                except Exception as e:
+                    print(f"Error during text generation: {str(e)}")
+                    print(traceback.format_exc())
+                    failed.set()
+                    streamer.end()
+
+            # The generation thread reports to the turn traced here
+            context = contextvars.copy_context()
+            thread = threading.Thread(target=context.run, args=(run_generation,), daemon=True)
+            started = time.perf_counter()
+            thread.start()
+
+            def chunks():
+                collected = []
+                try:
+                    for text in streamer:
+                        if text:
+                            if not collected:
+                                self.tracer.record("first_token", time.perf_counter() - started)
+                            collected.append(text)
+                            yield text
+                finally:
+                    stop_event.set()
+                    thread.join()
+                    # Cache what the caller consumed; it stops reading once it has enough
+                    generated_text = "".join(collected).strip()
+                    cancelled = cancel_event is not None and cancel_event.is_set()
+                    if not failed.is_set() and not cancelled:
+                        self.cache_response(
+                            prompt, model_prompt, self.cache_params(max_new_tokens, sampling), generated_text
+                        )
+
+            return chunks(), query_type
+
+        except Exception as e:
+            print(f"Error generating response: {str(e)}")
+            print(traceback.format_exc())
+            return iter(["I apologize, but I encountered an error. Could you try asking again?"]), "error"
+
+    async def generate_response_async(self, prompt, conversation_history=None, max_new_tokens=50,
+                                      model_prompt=None, parsed=None, sampling=None):
+        """
+        Asynchronous generate_response.
+
+        The blocking work runs in the event loop's default executor, in a
+        copy of the caller's context (so it is traced as part of its turn).
+        Cancelling the awaiting task stops the model at its next token.
+        """
+        loop = asyncio.get_running_loop()
+        cancel_event = threading.Event()
+        call = functools.partial(
+            self.generate_response, prompt, conversation_history, max_new_tokens,
+            model_prompt, parsed, cancel_event=cancel_event, sampling=sampling
+        )
+        try:
+            return await loop.run_in_executor(None, contextvars.copy_context().run, call)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+    async def generate_candidates_async(self, prompt, num_candidates, max_new_tokens=50, sampling=None):
+        """Asynchronous generate_candidates; cancelling stops every candidate at its next token."""
+        loop = asyncio.get_running_loop()
+        cancel_event = threading.Event()
+        call = functools.partial(
+            self.generate_candidates, prompt, num_candidates, max_new_tokens,
+            cancel_event=cancel_event, sampling=sampling
+        )
+        try:
+            return await loop.run_in_executor(None, contextvars.copy_context().run, call)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+    async def stream_response_async(self, prompt, conversation_history=None, max_new_tokens=50,
+                                    model_prompt=None, parsed=None, sampling=None):
+        """
+        Asynchronous stream_response.
+
+        Returns a (chunks, query_type) tuple where chunks is an async iterator
+        of decoded text pieces. A worker in the default executor reads the
+        blocking stream and hands chunks to the event loop as they arrive.
+        Closing chunks early stops the model at its next token (keeping
+        what was read for the response cache, as with stream_response);
+        cancelling the task that reads it discards the response.
+        """
+        loop = asyncio.get_running_loop()
+        cancel_event = threading.Event()
+        call = functools.partial(
+            self.stream_response, prompt, conversation_history, max_new_tokens,
+            model_prompt, parsed, cancel_event=cancel_event, sampling=sampling
+        )
+        try:
+            chunks, query_type = await loop.run_in_executor(None, contextvars.copy_context().run, call)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+        return self._async_chunks(loop, chunks, cancel_event), query_type
+
+    async def _async_chunks(self, loop, chunks, cancel_event):
+        queue = asyncio.Queue()
+        closing = threading.Event()
+        done = object()
+
+        def pump():
+            # Iterating and closing chunks both happen on this worker thread
+            try:
+                for chunk in chunks:
+                    if closing.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+            finally:
+                if hasattr(chunks, "close"):
+                    chunks.close()
+                try:
+                    loop.call_soon_threadsafe(queue.put_nowait, done)
+                except RuntimeError:
+                    pass  # The event loop has already closed
+
+        loop.run_in_executor(None, pump)
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is done:
+                    break
+                yield chunk
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+        finally:
+            closing.set()
@@ -0,0 +1,123 @@
+"""
+model_registry.py
+One loaded copy of each model per process, shared by every ModelLoader that asks for it
+"""
+
+import copy
+import os
+import sys
+import threading
+
+try:
+    import resource
+except ImportError:
+    # Unix only; peak memory is not reported elsewhere (e.g. Windows)
+    resource = None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, or None where it cannot be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb():
+    """Current resident set size of this process, or None where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+class SharedModel:
+    """A loaded tokenizer and text-generation pipeline, and how many loaders use them."""
+
+    def __init__(self, tokenizer, generator, snapshot=None):
+        self.tokenizer = tokenizer
+        self.generator = generator
+        # A second tokenizer for counting prompt tokens, so counting (done for
+        # every turn, model-bound or not) never waits for a generation
+        self.counting_tokenizer = copy.deepcopy(tokenizer)
+        self.counting_lock = threading.Lock()
+        # "loaded" or "saved" if a snapshot was involved in the load
+        self.snapshot = snapshot
+        self.warmed_up = False
+        # Fast tokenizers are not thread-safe, so every loader sharing this
+        # model makes its tokenizer and generation calls under this lock
+        self.lock = threading.RLock()
+        # Handle of the forward-pass counting hook speculative decoding adds
+        self.forward_hook = None
+        self.users = 0
+
+
+class ModelRegistry:
+    def __init__(self):
+        """
+        Loaded models keyed by everything that changes the loaded weights.
+
+        The first loader to ask for a key builds the model; later ones get
+        the same objects, so a process holds one copy of the weights however
+        many ModelLoaders (or ChatbotInterfaces) it creates. Loaders asking
+        for the same key at the same time wait for the one building it.
+        """
+        self.models = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, load):
+        """
+        Get the shared model for key, building it with load() if it is not loaded yet.
+
+        Args:
+            key (tuple): Model name, backend, device, dtype and snapshot directory
+            load (callable): Returns a new SharedModel
+
+        Returns:
+            tuple: (SharedModel, True if it was already loaded)
+        """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                model = self.models.get(key)
+            reused = model is not None
+            if not reused:
+                model = load()
+            with self._lock:
+                self.models[key] = model
+                model.users += 1
+        return model, reused
+
+    def release(self, key):
+        """
+        Drop one user of a model; the last one removes it from the registry.
+
+        Returns:
+            bool: True if no loader uses the model any more
+        """
+        with self._lock:
+            model = self.models.get(key)
+            if model is None:
+                return True
+            model.users -= 1
+            if model.users <= 0:
+                del self.models[key]
+                return True
+            return False
+
+    def get_stats(self):
+        """Users of each loaded model."""
+        with self._lock:
+            return [
+                {"model": key[0], "backend": key[1], "dtype": key[3], "users": model.users}
+                for key, model in self.models.items()
+            ]
+
+
+# Shared by every ModelLoader in the process unless it is created with shared=False
+registry = ModelRegistry()
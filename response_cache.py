@@ -0,0 +1,188 @@
+"""
+response_cache.py
+Caches generated responses so repeated questions skip the model
+"""
+
+from collections import OrderedDict
+import atexit
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
+
+def normalize_text(text):
+    """Lowercase text and collapse whitespace."""
+    return " ".join(text.lower().split())
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1024, ttl_seconds=24 * 3600, path=None,
+                 embed=None, similarity_threshold=0.95):
+        """
+        Two-tier cache of generated responses.
+
+        The exact tier is keyed on the normalized model prompt (which holds
+        the relevant history) and the sampling parameters. The optional
+        semantic tier compares embeddings of the question among entries with
+        the same history and parameters. Entries expire after ttl_seconds and
+        the least recently used entry is evicted once max_entries is reached.
+
+        Args:
+            max_entries (int): Maximum number of cached responses
+            ttl_seconds (float): Lifetime of an entry, None for no expiry
+            path (str): JSON file to load from and save to on exit
+            embed (callable): Maps text to a vector; enables the semantic tier
+            similarity_threshold (float): Minimum cosine similarity for a semantic hit
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+        self._lock = threading.Lock()
+
+        if path:
+            self.load()
+            atexit.register(self.save)
+
+    @staticmethod
+    def _hash(*parts):
+        return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def params_key(params):
+        """Stable string for a dict of generation parameters."""
+        return json.dumps(params, sort_keys=True, default=str)
+
+    def _keys(self, question, model_prompt, params):
+        """Exact key and semantic scope (history + parameters) for a request."""
+        params = self.params_key(params)
+        model_prompt = normalize_text(model_prompt or question)
+        question = normalize_text(question)
+        # Whatever precedes the question in the model prompt is its history
+        cut = model_prompt.rfind(question)
+        history = model_prompt[:cut] if cut != -1 else model_prompt
+        return self._hash(model_prompt, params), self._hash(history, params)
+
+    def _is_expired(self, entry, now):
+        return self.ttl_seconds is not None and now - entry["created"] > self.ttl_seconds
+
+    def _embed(self, question):
+        vector = [float(x) for x in self.embed(normalize_text(question))]
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def get(self, question, model_prompt, params):
+        """
+        Look up a cached response.
+
+        Args:
+            question (str): The user's input
+            model_prompt (str): The prompt the model would continue
+            params (dict): Generation parameters the response depends on
+
+        Returns:
+            str: The cached response, or None on a miss
+        """
+        key, scope = self._keys(question, model_prompt, params)
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if self._is_expired(entry, now):
+                    del self.entries[key]
+                    self.stats["expired"] += 1
+                else:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return entry["response"]
+
+        if self.embed is not None:
+            vector = self._embed(question)
+            with self._lock:
+                best_key, best_score = None, self.similarity_threshold
+                for candidate_key, entry in self.entries.items():
+                    if entry["scope"] != scope or entry["embedding"] is None:
+                        continue
+                    if self._is_expired(entry, now):
+                        continue
+                    score = sum(a * b for a, b in zip(vector, entry["embedding"]))
+                    if score >= best_score:
+                        best_key, best_score = candidate_key, score
+                if best_key is not None:
+                    self.entries.move_to_end(best_key)
+                    self.stats["semantic_hits"] += 1
+                    return self.entries[best_key]["response"]
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, question, model_prompt, params, response):
+        """Store a generated response."""
+        key, scope = self._keys(question, model_prompt, params)
+        embedding = self._embed(question) if self.embed is not None else None
+        with self._lock:
+            self.entries[key] = {
+                "response": response,
+                "scope": scope,
+                "embedding": embedding,
+                "created": time.time()
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        """Counters plus the current size and hit rate."""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self.entries)
+        lookups = stats["hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["semantic_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def save(self, path=None):
+        """Write unexpired entries to a JSON file, replacing it atomically."""
+        path = path or self.path
+        if not path:
+            return
+        now = time.time()
+        with self._lock:
+            entries = [
+                [key, entry] for key, entry in self.entries.items()
+                if not self._is_expired(entry, now)
+            ]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "entries": entries}, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path=None):
+        """Read entries saved by save(), skipping expired ones."""
+        path = path or self.path
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable response cache {path}: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for key, entry in data.get("entries", []):
+                if not self._is_expired(entry, now):
+                    self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
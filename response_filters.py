@@ -0,0 +1,252 @@
+"""
+response_filters.py
+Cleanup and validity rules for model output, compiled once
+"""
+
+import re
+
+# Fragments stripped from raw model output
+UNWANTED_PATTERNS = [
+    r'\[.*?\]',          # Text in square brackets
+    r'Bot:',             # Speaker labels
+    r'User:',
+    r'Human:',
+    r'Assistant:',
+    r'System:',
+    r'Instructions:.*?\\n\\n',  # Remove instruction block
+    r'Example interactions:.*?Current conversation:',  # Remove examples
+    r'This person would be',     # Common irrelevant starts
+    r'No other word for',
+    r'Or do anyone'
+]
+
+# Phrases that mark a response as meaningless (matched on lowercase text)
+MEANINGLESS_PATTERNS = [
+    r'would be the',
+    r'this person',
+    r'no other word',
+    r'or do anyone',
+    r'use your email',
+    r'social media accounts',
+    r'let\'s start by',
+    r'looking at how',
+    r'have to talk about',
+    r'speaking (?:french|spanish|english)',
+    r'interaction has taken',
+    r'need .* assistants',
+    r'someone named',
+    r'different countries'
+]
+
+# Inputs containing these must not be answered with a question
+QUESTION_WORDS = ['what', 'where', 'when', 'why', 'how']
+GREETING_WORDS = ['hi', 'hello', 'hey']
+
+# A speaker label means the model has started writing the next turn
+SPEAKER_LABEL = re.compile(r'(?:Bot|User|Human|Assistant|System):')
+
+SENTENCE_END = re.compile(r'[.!?]+')
+TRAILING_WORD = re.compile(r'\S*$')
+
+EMPTY_RESPONSE = "I apologize, but I'm having trouble generating a response."
+NO_SENTENCES_RESPONSE = "I apologize, but I need more context to provide a meaningful response."
+
+
+def combine(patterns):
+    """Fold a list of regexes into one alternation, or None if the list is empty."""
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+
+class ResponseFilter:
+    def __init__(self, unwanted_patterns=None, meaningless_patterns=None,
+                 question_words=None, greeting_words=None, max_sentences=2):
+        """
+        Build the cleanup and validity rules.
+
+        Each rule set is compiled into a single alternation, so a response is
+        scanned once per rule set however many rules it holds (cleanup
+        repeats the scan only when a removal exposes another fragment).
+
+        Args:
+            unwanted_patterns (list): Regexes removed from raw output
+            meaningless_patterns (list): Regexes that reject a response
+            question_words (list): Input words after which the bot must not ask a question
+            greeting_words (list): Greeting words after which the bot must not ask a question
+            max_sentences (int): Sentences kept by clean()
+        """
+        self.unwanted_patterns = list(UNWANTED_PATTERNS if unwanted_patterns is None else unwanted_patterns)
+        self.meaningless_patterns = list(
+            MEANINGLESS_PATTERNS if meaningless_patterns is None else meaningless_patterns
+        )
+        self.question_words = list(QUESTION_WORDS if question_words is None else question_words)
+        self.greeting_words = list(GREETING_WORDS if greeting_words is None else greeting_words)
+        self.max_sentences = max_sentences
+        self.compile()
+
+    def compile(self):
+        """(Re)build the combined regexes after the rule lists change."""
+        self.unwanted = combine(self.unwanted_patterns)
+        self.meaningless = combine(self.meaningless_patterns)
+        # Plain substring matches, as in the original checks
+        self.no_question_inputs = combine(
+            [re.escape(word) for word in self.question_words + self.greeting_words]
+        )
+
+    def add_unwanted_pattern(self, pattern):
+        self.unwanted_patterns.append(pattern)
+        self.compile()
+
+    def add_meaningless_pattern(self, pattern):
+        self.meaningless_patterns.append(pattern)
+        self.compile()
+
+    def strip_unwanted(self, text):
+        """
+        Remove unwanted fragments until none are left.
+
+        One pass is not enough: removing "[x]" from "Bo[x]t:" leaves a
+        "Bot:" that the same pass has already moved past.
+        """
+        if not self.unwanted:
+            return text
+        # Compare texts rather than count matches: a rule that can match ""
+        # always "matches" without removing anything
+        while True:
+            stripped = self.unwanted.sub('', text)
+            if stripped == text:
+                return text
+            text = stripped
+
+    def sentences(self, text):
+        """Sentences of three or more words, in order."""
+        kept = []
+        for sentence in SENTENCE_END.split(text):
+            sentence = sentence.strip()
+            if sentence and len(sentence.split()) > 2:
+                kept.append(sentence)
+        return kept
+
+    def clean(self, response):
+        """
+        Strip unwanted fragments and keep the first coherent sentences.
+
+        Args:
+            response (str): Raw model output
+
+        Returns:
+            str: Cleaned response
+        """
+        if not response:
+            return EMPTY_RESPONSE
+
+        text = ' '.join(self.strip_unwanted(response).split())
+        sentences = self.sentences(text)
+        if not sentences:
+            return NO_SENTENCES_RESPONSE
+        return '. '.join(sentences[:self.max_sentences]) + '.'
+
+    def is_rejected(self, lowered_response, lowered_input):
+        """The checks that only get worse as a response grows."""
+        if lowered_input in lowered_response:
+            return True
+        return bool(self.meaningless and self.meaningless.search(lowered_response))
+
+    def is_valid(self, response, user_input):
+        """
+        Validate a cleaned response against the user's input.
+
+        Args:
+            response (str): Cleaned response
+            user_input (str): The user's input
+
+        Returns:
+            bool: True if the response is valid
+        """
+        # Check for minimum length
+        if len(response.split()) < 3:
+            return False
+
+        lowered_input = user_input.lower()
+        if self.is_rejected(response.lower(), lowered_input):
+            return False
+
+        # No questions back in answer to questions or greetings
+        if '?' in response and self.no_question_inputs and self.no_question_inputs.search(lowered_input):
+            return False
+        return True
+
+    def process(self, response, user_input):
+        """
+        Clean a response and check it.
+
+        Returns:
+            tuple: (cleaned response, True if it is valid)
+        """
+        cleaned = self.clean(response)
+        return cleaned, self.is_valid(cleaned, user_input)
+
+    def score(self, response, user_input):
+        """
+        Clean a candidate response and rate it.
+
+        Valid candidates score higher the more complete sentences and words
+        they have (up to the kept length), and lower for repeated words.
+
+        Returns:
+            tuple: (cleaned response, score, or None if the response is invalid)
+        """
+        cleaned, valid = self.process(response, user_input)
+        # The canned cleanup results are not answers
+        if not valid or cleaned in (EMPTY_RESPONSE, NO_SENTENCES_RESPONSE):
+            return cleaned, None
+        words = cleaned.lower().split()
+        repeats = len(words) - len(set(words))
+        sentences = cleaned.count('. ') + 1
+        return cleaned, sentences * 10 + min(len(words), 30) - repeats * 2
+
+    def clean_partial(self, raw):
+        """
+        Clean a response that is still being generated.
+
+        Only text that is certain to survive clean() is returned: the word
+        still being decoded is held back, and a sentence is shown once it has
+        three words (shorter ones are dropped by clean()).
+
+        Args:
+            raw (str): Model output decoded so far
+
+        Returns:
+            tuple: (displayable text, True if no more output is needed)
+        """
+        finished = False
+        match = SPEAKER_LABEL.search(raw)
+        if match:
+            raw = raw[:match.start()]
+            finished = True
+        else:
+            # The last word may still be growing (or be the start of a label)
+            raw = TRAILING_WORD.sub('', raw)
+
+        # An unclosed bracket may still be removed once it closes
+        bracket = raw.rfind('[')
+        if bracket != -1 and ']' not in raw[bracket:]:
+            raw = raw[:bracket]
+
+        text = ' '.join(self.strip_unwanted(raw).split())
+
+        pieces = SENTENCE_END.split(text)
+        # The last piece is incomplete unless the text ends a sentence
+        sentences = self.sentences(' . '.join(pieces[:-1]))
+        if len(sentences) >= self.max_sentences:
+            return '. '.join(sentences[:self.max_sentences]) + '.', True
+
+        current = pieces[-1].strip()
+        if len(current.split()) > 2:
+            sentences.append(current)
+
+        partial = '. '.join(sentences)
+        if finished and sentences:
+            partial += '.'
+        return partial, finished
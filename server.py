@@ -0,0 +1,411 @@
+"""
+server.py
+Serves many chat sessions from one loaded model, batching model-bound turns
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from interface import ChatbotInterface
+from backends import BACKENDS, DTYPES
+from chat_memory import ChatMemory
+from conversation_store import ConversationStore
+from knowledge_base import SQLiteKnowledgeBase
+from response_cache import ResponseCache
+from worker_pool import WorkerPool
+import argparse
+import json
+import queue
+import threading
+import time
+import traceback
+
+
+class ChatSession:
+    """Conversation state for one client."""
+
+    def __init__(self, memory_turns=5, max_prompt_tokens=None, count_tokens=None, store=None, session_id=None):
+        self.memory = ChatMemory(
+            max_turns=memory_turns,
+            max_prompt_tokens=max_prompt_tokens,
+            count_tokens=count_tokens,
+            store=store,
+            session_id=session_id
+        )
+        self.current_context = None
+        self.lock = threading.Lock()
+
+
+class PendingGeneration:
+    """A model prompt waiting in the batch queue."""
+
+    def __init__(self, prompt):
+        self.prompt = prompt
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class BatchScheduler:
+    def __init__(self, model_loader, max_batch_size=8, max_wait_ms=20, max_new_tokens=50):
+        """
+        Collect pending prompts into dynamic batches for the model.
+
+        A batch is sent as soon as it is full or the oldest prompt has waited
+        max_wait_ms. Larger batches raise throughput; a shorter wait lowers
+        latency when traffic is light.
+
+        Args:
+            model_loader (ModelLoader): Loaded model shared by all sessions
+            max_batch_size (int): Maximum prompts per generator call
+            max_wait_ms (float): How long to wait for a batch to fill
+            max_new_tokens (int): Tokens to generate per prompt
+        """
+        self.model_loader = model_loader
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_new_tokens = max_new_tokens
+        self.queue = queue.Queue()
+        self.stats = {"batches": 0, "prompts": 0, "generation_seconds": 0.0}
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt):
+        """Queue a prompt and block until its generated text is ready."""
+        pending = PendingGeneration(prompt)
+        self.queue.put(pending)
+        return pending.wait()
+
+    def _collect(self):
+        """Block for the first prompt, then gather more until the batch is full or the wait expires."""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            try:
+                results = self.model_loader.generate_batch(
+                    [pending.prompt for pending in batch],
+                    max_new_tokens=self.max_new_tokens
+                )
+                for pending, result in zip(batch, results):
+                    pending.result = result
+            except Exception as e:
+                print(f"Error during batched generation: {str(e)}")
+                print(traceback.format_exc())
+                for pending in batch:
+                    pending.error = e
+            finally:
+                self.stats["batches"] += 1
+                self.stats["prompts"] += len(batch)
+                self.stats["generation_seconds"] += time.perf_counter() - start
+                for pending in batch:
+                    pending.done.set()
+
+
+class ChatServer:
+    def __init__(self, model_name="distilgpt2", memory_turns=5, max_batch_size=8, max_wait_ms=20,
+                 knowledge_base=None, response_cache=None, backend="pytorch", conversation_store=None,
+                 trace=False, snapshot_dir=None, warmup_lengths=None, dtype=None):
+        """
+        Initialize a server holding one model and one memory per session.
+
+        Args:
+            model_name (str): Hugging Face model name
+            memory_turns (int): Number of conversation turns to remember per session
+            max_batch_size (int): Maximum prompts per generator call
+            max_wait_ms (float): How long a prompt may wait for its batch to fill
+            knowledge_base: Backend for factual answers, defaults to the built-in facts
+            response_cache (ResponseCache): Cache of generated responses, off by default
+            backend (str): Inference backend: "pytorch", "int8", "compile" or "onnx"
+            conversation_store (ConversationStore): Persists sessions so they
+                resume by ID after a restart, off by default
+            trace (bool): Record per-stage timings, served at GET /metrics
+            snapshot_dir (str): Directory for a fast-loading copy of the weights, made on first load
+            warmup_lengths (tuple): Prompt lengths (tokens) of dummy generations run after loading
+            dtype (str): Weight precision, "float16" or "bfloat16"; float32 by default
+        """
+        # The interface supplies the shared model and response post-processing
+        self.chatbot = ChatbotInterface(
+            model_name=model_name,
+            memory_turns=memory_turns,
+            knowledge_base=knowledge_base,
+            response_cache=response_cache,
+            backend=backend,
+            trace=trace,
+            snapshot_dir=snapshot_dir,
+            warmup_lengths=warmup_lengths,
+            dtype=dtype
+        )
+        self.tracer = self.chatbot.tracer
+        self.response_cache = response_cache
+        self.conversation_store = conversation_store
+        self.model_loader = self.chatbot.model_loader
+        self.memory_turns = memory_turns
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.scheduler = None
+        self.max_prompt_tokens = None
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        # parse_query keeps the current place on the loader, so it is
+        # swapped in and out per session under this lock
+        self.parse_lock = threading.Lock()
+
+    def initialize(self):
+        """Load the model and start the batch scheduler."""
+        self.model_loader.load_model()
+        self.scheduler = BatchScheduler(
+            self.model_loader,
+            max_batch_size=self.max_batch_size,
+            max_wait_ms=self.max_wait_ms
+        )
+        # Prompts are assembled newest-first within the model's context window
+        window = self.model_loader.context_window()
+        if window:
+            self.max_prompt_tokens = window - self.scheduler.max_new_tokens
+
+    def get_session(self, session_id):
+        with self.sessions_lock:
+            if session_id not in self.sessions:
+                self.sessions[session_id] = ChatSession(
+                    self.memory_turns,
+                    max_prompt_tokens=self.max_prompt_tokens,
+                    count_tokens=self.model_loader.count_tokens,
+                    store=self.conversation_store,
+                    session_id=session_id
+                )
+            return self.sessions[session_id]
+
+    def _parse(self, session, message, conversation_history=None):
+        with self.parse_lock:
+            self.model_loader.current_context = session.current_context
+            topic, context, query_type = self.model_loader.parse_query(message, conversation_history)
+            session.current_context = self.model_loader.current_context
+        return topic, query_type
+
+    def handle_message(self, session_id, message):
+        """
+        Process one turn for a session.
+
+        Args:
+            session_id (str): Client session identifier
+            message (str): The user's input
+
+        Returns:
+            dict: The response and its query type
+        """
+        session = self.get_session(session_id)
+        message = message.strip()
+
+        with session.lock:
+            self.tracer.start_turn()
+            if message.lower() == "/clear":
+                session.memory.clear()
+                session.current_context = None
+                return {"response": "Conversation history cleared.", "query_type": "command"}
+
+            with self.tracer.stage("build_prompt"):
+                model_prompt = session.memory.get_prompt(message)
+            topic, query_type = self._parse(session, message, session.memory)
+            session.memory.add_message("User", message, query_type)
+
+            with self.tracer.stage("knowledge_base"):
+                response = self.model_loader.answer_from_knowledge(topic, query_type)
+            if response is None:
+                self.tracer.count("knowledge_base_misses")
+                response = self._generate(message, model_prompt)
+            else:
+                self.tracer.count("knowledge_base_hits")
+
+            response = self.chatbot.finalize_response(response, message)
+            session.memory.add_message("Bot", response, query_type)
+            self.tracer.finish_turn()
+            return {"response": response, "query_type": query_type}
+
+    def _generate(self, message, model_prompt):
+        """Run a model-bound turn through the response cache and the batch queue."""
+        params = self.model_loader.cache_params(self.scheduler.max_new_tokens)
+        if self.response_cache is not None:
+            with self.tracer.stage("response_cache"):
+                cached = self.response_cache.get(message, model_prompt, params)
+            if cached is not None:
+                self.tracer.count("response_cache_hits")
+                return cached
+            self.tracer.count("response_cache_misses")
+
+        with self.tracer.stage("batch_queue"):
+            response = self.scheduler.submit(model_prompt)
+        if self.response_cache is not None:
+            self.model_loader.cache_response(message, model_prompt, params, response)
+        return response
+
+    def get_stats(self):
+        stats = dict(self.scheduler.stats)
+        stats["sessions"] = len(self.sessions)
+        if stats["batches"]:
+            stats["average_batch_size"] = stats["prompts"] / stats["batches"]
+        if self.response_cache is not None:
+            stats["response_cache"] = self.response_cache.get_stats()
+        if self.tracer.enabled:
+            stats["trace"] = self.tracer.snapshot()
+        return stats
+
+    def metrics(self):
+        """Tracing statistics in the Prometheus text format."""
+        return self.tracer.to_prometheus()
+
+    def close(self):
+        """Write out any queued conversation history."""
+        if self.conversation_store is not None:
+            self.conversation_store.close()
+
+
+def make_handler(server):
+    class ChatRequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_text(self, status, text):
+            body = text.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(200, server.get_stats())
+            elif self.path == "/metrics" and hasattr(server, "metrics"):
+                self._send_text(200, server.metrics())
+            else:
+                self._send_json(404, {"error": "Not found"})
+
+        def do_POST(self):
+            if self.path != "/chat":
+                self._send_json(404, {"error": "Not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                session_id = str(request["session_id"])
+                message = request["message"]
+            except (ValueError, KeyError):
+                self._send_json(400, {"error": "Expected JSON with session_id and message"})
+                return
+            try:
+                self._send_json(200, server.handle_message(session_id, message))
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ChatRequestHandler
+
+
+def main():
+    """Run the chat server."""
+    parser = argparse.ArgumentParser(description="Serve the chatbot to many sessions over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", default="distilgpt2", help="Hugging Face model name")
+    parser.add_argument("--memory-turns", type=int, default=5)
+    parser.add_argument("--backend", default="pytorch", choices=BACKENDS, help="Inference backend")
+    parser.add_argument("--dtype", choices=DTYPES, help="Weight precision (default float32)")
+    parser.add_argument("--batch-size", type=int, help="Maximum prompts per generation batch (default 8)")
+    parser.add_argument("--max-wait-ms", type=float, help="How long to wait for a batch to fill (default 20)")
+    parser.add_argument("--knowledge-base", help="SQLite knowledge base built with knowledge_base.py")
+    parser.add_argument("--response-cache", help="JSON file for the response cache (enables caching)")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Maximum cached responses")
+    parser.add_argument("--conversations", help="SQLite file that persists sessions across restarts")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the model (CPU only); 1 serves from this process")
+    parser.add_argument("--trace", action="store_true", help="Record per-stage timings (GET /metrics)")
+    parser.add_argument("--snapshot-dir", help="Keep a safetensors copy of the weights here for fast restarts")
+    parser.add_argument("--warmup", type=int, nargs="*", metavar="TOKENS",
+                        help="Warm up with dummy prompts of these lengths before serving (default 16 64 256)")
+    args = parser.parse_args()
+    if args.workers > 1:
+        # Worker processes answer one turn at a time and keep no shared tracer
+        unsupported = [
+            flag for flag, value in (
+                ("--trace", args.trace),
+                ("--batch-size", args.batch_size is not None),
+                ("--max-wait-ms", args.max_wait_ms is not None)
+            ) if value
+        ]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)} cannot be used with --workers > 1")
+
+    knowledge_base = SQLiteKnowledgeBase(args.knowledge_base) if args.knowledge_base else None
+    response_cache = (
+        ResponseCache(max_entries=args.cache_size, path=args.response_cache)
+        if args.response_cache else None
+    )
+    warmup_lengths = None
+    if args.warmup is not None:
+        warmup_lengths = tuple(args.warmup) or (16, 64, 256)
+    if args.workers > 1:
+        chat_server = WorkerPool(
+            model_name=args.model,
+            num_workers=args.workers,
+            memory_turns=args.memory_turns,
+            backend=args.backend,
+            knowledge_base=knowledge_base,
+            response_cache=response_cache,
+            conversations=args.conversations,
+            snapshot_dir=args.snapshot_dir,
+            warmup_lengths=warmup_lengths,
+            dtype=args.dtype
+        )
+    else:
+        chat_server = ChatServer(
+            model_name=args.model,
+            memory_turns=args.memory_turns,
+            max_batch_size=args.batch_size or 8,
+            max_wait_ms=20 if args.max_wait_ms is None else args.max_wait_ms,
+            backend=args.backend,
+            knowledge_base=knowledge_base,
+            response_cache=response_cache,
+            conversation_store=ConversationStore(args.conversations) if args.conversations else None,
+            trace=args.trace,
+            snapshot_dir=args.snapshot_dir,
+            warmup_lengths=warmup_lengths,
+            dtype=args.dtype
+        )
+    chat_server.initialize()
+
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(chat_server))
+    print(f"Serving on http://{args.host}:{args.port} (POST /chat, GET /stats, GET /metrics)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down server.")
+    finally:
+        httpd.server_close()
+        chat_server.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+tracing.py
+Per-stage timings and counters for chat turns
+"""
+
+from collections import deque
+import contextvars
+import json
+import threading
+import time
+
+# The turn being traced; copied into helper threads along with the context
+_current_turn = contextvars.ContextVar("current_turn", default=None)
+
+
+class _NoStage:
+    """Context manager used while tracing is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_STAGE = _NoStage()
+
+
+class _Stage:
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class TurnTrace:
+    """Timings and counters of one turn."""
+    __slots__ = ("started", "stages", "counters")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+
+    def to_dict(self):
+        return {
+            "stages_ms": {name: seconds * 1000 for name, seconds in self.stages.items()},
+            "counters": dict(self.counters)
+        }
+
+
+class Tracer:
+    def __init__(self, enabled=False, recent_turns=100):
+        """
+        Collect per-stage timings, token counts and cache/knowledge-base hits.
+
+        Stages are timed with `with tracer.stage(name):`. While disabled,
+        stage() returns a shared no-op context manager and count() and
+        record() return at once, so the calls cost next to nothing.
+
+        Args:
+            enabled (bool): Record anything at all
+            recent_turns (int): Number of finished turns kept for inspection
+        """
+        self.enabled = enabled
+        self.stages = {}  # name -> [count, total seconds, max seconds]
+        self.counters = {}
+        self.turns = 0
+        self.recent = deque(maxlen=recent_turns)
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """Context manager timing one stage."""
+        if not self.enabled:
+            return NO_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        """Add a measured duration to a stage (and to the current turn)."""
+        if not self.enabled:
+            return
+        turn = _current_turn.get()
+        with self._lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+            if turn is not None:
+                turn.stages[name] = turn.stages.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        """Increment a counter (and the current turn's)."""
+        if not self.enabled:
+            return
+        turn = _current_turn.get()
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+            if turn is not None:
+                turn.counters[name] = turn.counters.get(name, 0) + amount
+
+    def start_turn(self):
+        """Begin tracing a turn in the current context, replacing any unfinished one."""
+        if self.enabled:
+            _current_turn.set(TurnTrace())
+
+    def finish_turn(self):
+        """Record the current turn's total time and keep it among the recent turns."""
+        if not self.enabled:
+            return
+        turn = _current_turn.get()
+        if turn is None:
+            return
+        _current_turn.set(None)
+        elapsed = time.perf_counter() - turn.started
+        self.record("turn", elapsed)
+        turn.stages["turn"] = elapsed
+        with self._lock:
+            self.turns += 1
+            self.recent.append(turn)
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.turns = 0
+            self.recent.clear()
+
+    def snapshot(self):
+        """All statistics as a JSON-serializable dict."""
+        with self._lock:
+            stages = {
+                name: {
+                    "count": count,
+                    "total_ms": total * 1000,
+                    "mean_ms": total / count * 1000,
+                    "max_ms": longest * 1000
+                }
+                for name, (count, total, longest) in self.stages.items()
+            }
+            return {
+                "enabled": self.enabled,
+                "turns": self.turns,
+                "stages": stages,
+                "counters": dict(self.counters),
+                "last_turn": self.recent[-1].to_dict() if self.recent else None
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix="chatbot"):
+        """Statistics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = [
+            f"# TYPE {prefix}_turns_total counter",
+            f"{prefix}_turns_total {snapshot['turns']}",
+            f"# TYPE {prefix}_stage_seconds summary"
+        ]
+        for name, stats in sorted(snapshot["stages"].items()):
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stats["count"]}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stats["total_ms"] / 1000:.6f}')
+        lines.append(f"# TYPE {prefix}_stage_seconds_max gauge")
+        for name, stats in sorted(snapshot["stages"].items()):
+            lines.append(f'{prefix}_stage_seconds_max{{stage="{name}"}} {stats["max_ms"] / 1000:.6f}')
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def format_table(self):
+        """Human-readable summary for the CLI."""
+        snapshot = self.snapshot()
+        lines = [f"Turns traced: {snapshot['turns']}"]
+        if snapshot["stages"]:
+            lines.append(f"  {'stage':22} {'count':>7} {'mean ms':>10} {'max ms':>10} {'total ms':>11}")
+            ordered = sorted(snapshot["stages"].items(), key=lambda item: -item[1]["total_ms"])
+            for name, stats in ordered:
+                lines.append(
+                    f"  {name:22} {stats['count']:7d} {stats['mean_ms']:10.2f} "
+                    f"{stats['max_ms']:10.2f} {stats['total_ms']:11.2f}"
+                )
+        if snapshot["counters"]:
+            lines.append("  " + ", ".join(f"{name}={value}" for name, value in sorted(snapshot["counters"].items())))
+        return "\n".join(lines)
@@ -0,0 +1,275 @@
+"""
+worker_pool.py
+Runs chat turns in forked worker processes that share one copy of the model
+"""
+
+from concurrent.futures import Future
+from interface import ChatbotInterface
+from chat_memory import ChatMemory
+from conversation_store import ConversationStore
+import gc
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+
+def memory_usage_mb(pid):
+    """
+    Resident and proportional set size of a process, from /proc (Linux).
+
+    PSS splits pages shared between processes evenly among them, so summing
+    it over the pool shows the real footprint of shared weights.
+
+    Returns:
+        dict: {"rss_mb", "pss_mb"}, or None where /proc is unavailable
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", encoding="utf-8") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    usage = {}
+    for name, key in (("Rss", "rss_mb"), ("Pss", "pss_mb")):
+        if name in fields:
+            usage[key] = int(fields[name].split()[0]) / 1024
+    return usage
+
+
+def worker_main(chatbot, requests, results, torch_threads, conversations):
+    """
+    Serve turns from requests until a None arrives.
+
+    Runs in a forked child: the chatbot and its model come from the parent's
+    memory and stay shared until written to. Each session's memory and
+    current place live only in the worker its turns are routed to.
+    """
+    import torch
+
+    torch.set_num_threads(torch_threads)
+    # Threads and SQLite connections do not survive a fork, so the store is opened here
+    store = ConversationStore(conversations) if conversations else None
+    loader = chatbot.model_loader
+    memories = {}
+    contexts = {}
+
+    for request in iter(requests.get, None):
+        request_id, session_id, message = request
+        try:
+            memory = memories.get(session_id)
+            if memory is None:
+                memory = memories[session_id] = ChatMemory(
+                    max_turns=chatbot.memory.max_turns, store=store, session_id=session_id
+                )
+            message = message.strip()
+            if message.lower() == "/clear":
+                memory.clear()
+                contexts.pop(session_id, None)
+                results.put((request_id, {"response": "Conversation history cleared.", "query_type": "command"}, None))
+                continue
+
+            chatbot.memory = memory
+            loader.current_context = contexts.get(session_id)
+            response, query_type = chatbot.chat(message)
+            contexts[session_id] = loader.current_context
+            results.put((request_id, {"response": response, "query_type": query_type}, None))
+        except Exception as e:
+            print(f"Error in worker {os.getpid()}: {str(e)}")
+            print(traceback.format_exc())
+            results.put((request_id, None, str(e)))
+
+    if store is not None:
+        store.close()
+
+
+class WorkerPool:
+    def __init__(self, model_name="distilgpt2", num_workers=2, memory_turns=5, knowledge_base=None,
+                 response_cache=None, backend="pytorch", conversations=None, torch_threads=None, dtype=None,
+                 snapshot_dir=None, warmup_lengths=None):
+        """
+        Initialize a pool of worker processes sharing one loaded model.
+
+        The model is loaded once in this process and the workers are forked
+        from it, so the weights are shared copy-on-write instead of loaded
+        per worker. Each session is pinned to one worker (the least busy when
+        the session starts), which keeps its memory local to that process.
+        If a worker dies, its unanswered turns fail and its sessions move to
+        a live worker (resuming from the conversation store, if there is one).
+
+        Args:
+            model_name (str): Hugging Face model name
+            num_workers (int): Number of worker processes
+            memory_turns (int): Number of conversation turns to remember per session
+            knowledge_base: Backend for factual answers, defaults to the built-in facts
+            response_cache (ResponseCache): Cache of generated responses; each worker gets its own copy
+            backend (str): Inference backend: "pytorch", "int8", "compile" or "onnx"
+            conversations (str): SQLite file for a ConversationStore opened in each worker
+            torch_threads (int): Intra-op threads per worker, defaults to the cores divided among workers
+            dtype (str): Weight precision, "float16" or "bfloat16"; float32 by default
+            snapshot_dir (str): Directory holding a safetensors copy of the weights for fast restarts
+            warmup_lengths (tuple): Prompt lengths of dummy generations run before the workers are forked
+        """
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("The worker pool needs the fork start method (Linux or macOS)")
+        self.chatbot = ChatbotInterface(
+            model_name=model_name,
+            memory_turns=memory_turns,
+            knowledge_base=knowledge_base,
+            response_cache=response_cache,
+            backend=backend,
+            snapshot_dir=snapshot_dir,
+            warmup_lengths=warmup_lengths,
+            dtype=dtype
+        )
+        self.num_workers = num_workers
+        self.conversations = conversations
+        self.torch_threads = torch_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        self.workers = []
+        self.request_queues = []
+        self.results = None
+        self.pending = {}
+        self.assignments = {}
+        self.in_flight = [0] * num_workers
+        self.turns = [0] * num_workers
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def initialize(self):
+        """Load the model, then fork the workers and start collecting their results."""
+        loader = self.chatbot.model_loader
+        loader.load_model()
+        if loader.device != -1:
+            raise RuntimeError("The worker pool runs on CPU; CUDA cannot be used across fork")
+        # An open SQLite connection must not be inherited by the workers
+        if hasattr(loader.knowledge_base, "close"):
+            loader.knowledge_base.close()
+
+        context = multiprocessing.get_context("fork")
+        self.results = context.Queue()
+        # Objects allocated so far are left alone by the garbage collector,
+        # so collections in the workers do not copy their pages
+        gc.freeze()
+        for _ in range(self.num_workers):
+            requests = context.Queue()
+            worker = context.Process(
+                target=worker_main,
+                args=(self.chatbot, requests, self.results, self.torch_threads, self.conversations),
+                daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+            self.request_queues.append(requests)
+        gc.unfreeze()
+
+        threading.Thread(target=self._collect, daemon=True).start()
+
+    def _collect(self, check_every=1.0):
+        """Resolve futures as results arrive, checking every check_every seconds for dead workers."""
+        checked = time.monotonic()
+        while True:
+            # Checked on a timer, since live workers may keep results coming
+            if time.monotonic() - checked >= check_every:
+                self._fail_dead_workers()
+                checked = time.monotonic()
+            try:
+                request_id, result, error = self.results.get(timeout=check_every)
+            except queue.Empty:
+                continue
+            with self._lock:
+                entry = self.pending.pop(request_id, None)
+                if entry is None:
+                    # Already failed as belonging to a dead worker
+                    continue
+                future, index = entry
+                self.in_flight[index] -= 1
+                self.turns[index] += 1
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(result)
+
+    def _fail_dead_workers(self):
+        """Fail the unanswered turns of workers that have exited."""
+        failed = []
+        with self._lock:
+            for request_id, (future, index) in list(self.pending.items()):
+                worker = self.workers[index]
+                if not worker.is_alive():
+                    del self.pending[request_id]
+                    self.in_flight[index] -= 1
+                    failed.append((future, worker))
+        for future, worker in failed:
+            future.set_exception(RuntimeError(f"Worker {worker.pid} exited with code {worker.exitcode}"))
+
+    def _worker_for(self, session_id):
+        """Index of the live worker serving a session (the lock must be held)."""
+        index = self.assignments.get(session_id)
+        if index is None or not self.workers[index].is_alive():
+            live = [i for i, worker in enumerate(self.workers) if worker.is_alive()]
+            if not live:
+                raise RuntimeError("No worker processes are running")
+            sessions = [0] * self.num_workers
+            for assigned in self.assignments.values():
+                sessions[assigned] += 1
+            index = min(live, key=lambda i: (self.in_flight[i], sessions[i]))
+            self.assignments[session_id] = index
+        return index
+
+    def submit(self, session_id, message):
+        """
+        Route a turn to its session's worker.
+
+        Returns:
+            Future: Resolves to a dict with the response and its query type
+        """
+        future = Future()
+        with self._lock:
+            index = self._worker_for(session_id)
+            request_id = next(self._ids)
+            self.pending[request_id] = (future, index)
+            self.in_flight[index] += 1
+        self.request_queues[index].put((request_id, session_id, message))
+        return future
+
+    def handle_message(self, session_id, message):
+        """Process one turn for a session, blocking until its worker answers."""
+        return self.submit(session_id, message).result()
+
+    def get_stats(self):
+        """Turns, sessions and memory use per worker, plus the parent process."""
+        with self._lock:
+            sessions = [0] * self.num_workers
+            for assigned in self.assignments.values():
+                sessions[assigned] += 1
+            workers = [
+                {
+                    "pid": worker.pid,
+                    "alive": worker.is_alive(),
+                    "sessions": sessions[index],
+                    "in_flight": self.in_flight[index],
+                    "turns": self.turns[index],
+                    "memory": memory_usage_mb(worker.pid)
+                }
+                for index, worker in enumerate(self.workers)
+            ]
+        stats = {
+            "workers": workers,
+            "sessions": len(self.assignments),
+            "parent_memory": memory_usage_mb(os.getpid())
+        }
+        pss = [worker["memory"].get("pss_mb") for worker in workers if worker["memory"]]
+        if stats["parent_memory"] and pss and None not in pss:
+            stats["total_pss_mb"] = stats["parent_memory"].get("pss_mb", 0) + sum(pss)
+        return stats
+
+    def close(self):
+        """Stop the workers."""
+        for requests in self.request_queues:
+            requests.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()